@@ -0,0 +1,221 @@
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from app.concept_index import extract_key_concepts_chunked
+from app.condense import condense_note_blocks
+from app.llm import LLMCall, LLMUnavailable
+from app.note_queries import load_analysis_inputs
+from app.workers import run_in_pool
+
+
+async def load_detailed_context(db, user_id: str, class_id: str) -> Dict[str, Any]:
+    """
+    Gather everything the detailed analysis prompt needs: the student's notes and stored
+    concepts, and the classmates' notes with their extracted key concepts.
+    """
+    # Both sides' note contents and the stored concepts in one aggregation.
+    inputs = await load_analysis_inputs(db, user_id, class_id, include_others=True)
+    if not inputs["student_contents"]:
+        raise HTTPException(status_code=404, detail="No notes found for this student in this class.")
+
+    has_other_notes = inputs["other_note_count"] > 0
+    if not has_other_notes:
+        print("No other students' notes found for comparison. Proceeding with analysis of just this student's notes.")
+
+    student_content = " ".join(content for content in inputs["student_contents"] if content is not None)
+    print(f"Student content length: {len(student_content)}")
+    other_content = " ".join(inputs["other_contents"])
+    print(f"Other students' content length: {len(other_content)}")
+
+    student_concepts_doc = inputs["stored_concepts"]
+    student_concepts = student_concepts_doc.get("concepts", []) if student_concepts_doc else []
+    print(f"Student concepts: {student_concepts}")
+
+    # The classmates' text can be megabytes once PDFs are involved; extract it chunk-wise.
+    other_key_concepts = await extract_key_concepts_chunked(other_content) if has_other_notes else []
+
+    # Keep the sentences that best cover the key concepts instead of the first 3000 characters.
+    condensed = await run_in_pool(condense_note_blocks, student_content, other_content, student_concepts, other_key_concepts)
+    print(f"Prompt condensation saved {condensed['stats']['tokens_saved']} tokens")
+
+    return {
+        "user_id": user_id,
+        "class_id": class_id,
+        "has_other_notes": has_other_notes,
+        "student_content": student_content,
+        "other_content": other_content,
+        "student_concepts": student_concepts,
+        "other_key_concepts": other_key_concepts,
+        "student_content_condensed": condensed["student_content"],
+        "other_content_condensed": condensed["other_content"],
+        "condensation": condensed["stats"],
+    }
+
+
+def detailed_prompt(context: Dict[str, Any]) -> str:
+    student_content_condensed = context["student_content_condensed"]
+    other_content_condensed = context["other_content_condensed"]
+    student_concepts = context["student_concepts"]
+    other_key_concepts = context["other_key_concepts"]
+
+    # Always request strengthsAndWeaknesses regardless of whether other notes exist.
+    if context["has_other_notes"]:
+        return f"""
+        As an educational assistant, analyze these notes and focus on extracting valuable information from the dataset to enhance the student's notes.
+
+        STUDENT'S NOTES (TO BE ENHANCED):
+        {student_content_condensed}
+
+        DATASET (NOTES FROM OTHER STUDENTS FOR REFERENCE):
+        {other_content_condensed}
+
+        EXTRACTED KEY CONCEPTS FROM STUDENT'S NOTES:
+        {', '.join(student_concepts)}
+
+        EXTRACTED KEY CONCEPTS FROM DATASET:
+        {', '.join(other_key_concepts)}
+
+        Provide a JSON response with the following structure:
+        {{
+            "topicCoverage": [...],
+            "missingTopics": [...],
+            "datasetKnowledge": [...],
+            "qualityAssessment": "...",
+            "strengthsAndWeaknesses": {{
+                "strengths": [...],
+                "weaknesses": [...]
+            }},
+            "studyRecommendations": [...]
+        }}
+        """
+    return f"""
+        As an educational assistant, analyze these student notes and provide feedback.
+
+        STUDENT'S NOTES:
+        {student_content_condensed}
+
+        EXTRACTED KEY CONCEPTS FROM STUDENT'S NOTES:
+        {', '.join(student_concepts)}
+
+        Provide a JSON response with the following structure:
+        {{
+            "topicCoverage": [...],
+            "missingTopics": [...],
+            "datasetKnowledge": [...],
+            "qualityAssessment": "...",
+            "strengthsAndWeaknesses": {{
+                "strengths": [...],
+                "weaknesses": [...]
+            }},
+            "studyRecommendations": [...]
+        }}
+        """
+
+
+def parse_detailed_response(context: Dict[str, Any], response_text: str) -> Dict[str, Any]:
+    """
+    Turn Gemini's reply into the endpoint response, salvaging a JSON object embedded in
+    surrounding text when the reply is not pure JSON.
+    """
+    try:
+        analysis = json.loads(response_text)
+        return {
+            "status": "success",
+            "student_id": context["user_id"],
+            "class_id": context["class_id"],
+            "analysis": analysis
+        }
+    except json.JSONDecodeError as json_err:
+        print(f"JSON parsing error: {json_err}")
+        print(f"Raw response: {response_text}")
+        match = re.search(r'(\{.*\})', response_text, re.DOTALL)
+        if match:
+            try:
+                json_str = match.group(1)
+                analysis = json.loads(json_str)
+                return {
+                    "status": "success",
+                    "student_id": context["user_id"],
+                    "class_id": context["class_id"],
+                    "analysis": analysis
+                }
+            except Exception as ex:
+                print(f"Failed to parse extracted JSON: {ex}")
+        return {
+            "status": "partial_success",
+            "student_id": context["user_id"],
+            "class_id": context["class_id"],
+            "raw_analysis": response_text,
+            "basic_analysis": {
+                "topicCoverage": context["student_concepts"],
+                "qualityAssessment": "Analysis not available - please check raw_analysis field",
+                "strengthsAndWeaknesses": {"strengths": [], "weaknesses": []},
+                "studyRecommendations": []
+            },
+            "error": "Failed to parse response as JSON"
+        }
+
+
+def basic_detailed_analysis(context: Dict[str, Any], error: str) -> Dict[str, Any]:
+    """
+    Concept-based analysis served when Gemini is unavailable.
+    """
+    student_concepts = context["student_concepts"]
+    return {
+        "status": "partial_success",
+        "student_id": context["user_id"],
+        "class_id": context["class_id"],
+        "basic_analysis": {
+            "topicCoverage": student_concepts,
+            "missingTopics": [concept for concept in context["other_key_concepts"] if concept not in student_concepts],
+            "qualityAssessment": "Detailed analysis is temporarily unavailable",
+            "strengthsAndWeaknesses": {"strengths": [], "weaknesses": []},
+            "studyRecommendations": []
+        },
+        "error": error
+    }
+
+
+async def run_detailed_analysis(
+    db,
+    user_id: str,
+    class_id: str,
+    llm_calls: Optional[List[Dict[str, Any]]] = None,
+    endpoint: str = "detailed-note-analysis"
+) -> Dict[str, Any]:
+    """
+    Full detailed note analysis: load the context, ask Gemini, and parse its answer.
+    The instrumented Gemini call is recorded under `endpoint` and its summary appended
+    to `llm_calls` when given.
+    """
+    context = await load_detailed_context(db, user_id, class_id)
+    call = LLMCall(endpoint)
+    try:
+        prompt = detailed_prompt(context)
+        print("Sending prompt to Gemini API...")
+        print(f"Prompt length: {len(prompt)}")
+        async with call:
+            # Cached per prompt; identical concurrent requests share one Gemini call.
+            response_text = await call.generate(prompt)
+            print(f"Received response from Gemini API: {response_text[:100]}...")
+            result = parse_detailed_response(context, response_text)
+            if result["status"] != "success":
+                call.outcome = "json_parse_failure"
+        result = {**result, "condensation": context["condensation"]}
+    except LLMUnavailable as llm_err:
+        # Gemini is down, slow or short-circuited: answer right away with the concept-based analysis.
+        print(f"Gemini unavailable, serving basic analysis: {llm_err}")
+        result = {**basic_detailed_analysis(context, str(llm_err)), "condensation": context["condensation"]}
+    except Exception as gemini_err:
+        print(f"Gemini API error: {gemini_err}")
+        result = {
+            "status": "error",
+            "message": str(gemini_err),
+            "details": "Error occurred while processing Gemini API request"
+        }
+    if llm_calls is not None:
+        llm_calls.append(call.summary())
+    return result
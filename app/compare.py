@@ -0,0 +1,48 @@
+from typing import Any, Dict, List
+
+import numpy as np
+
+from app.embeddings import cosine_similarity_matrix, encode_phrases
+
+# Pure comparison functions run in the extraction process pool. They live outside the
+# route modules so that pool workers do not import FastAPI, the database or the LLM client.
+
+
+def compare_concepts(student_concepts: List[str], other_concepts: List[str], sim_threshold: float = 0.8) -> Dict[str, Any]:
+    """
+    Compare two lists of concept phrases semantically using one similarity matrix.
+    Each student concept is paired with its best-matching class concept (row argmax) and
+    each class concept with its best-matching student concept (column max), giving:
+      - common_concept_matches: student concepts whose best match reaches sim_threshold,
+        with the matched class concept and its score
+      - missing_concepts: class concepts with no student concept at or above sim_threshold
+      - extra_concepts: student concepts with no class concept at or above sim_threshold
+    """
+    if not student_concepts or not other_concepts:
+        return {
+            "common_concepts": [],
+            "common_concept_matches": [],
+            "missing_concepts": list(other_concepts),
+            "extra_concepts": list(student_concepts),
+        }
+
+    scores = cosine_similarity_matrix(encode_phrases(student_concepts), encode_phrases(other_concepts))
+    best_other = scores.argmax(axis=1)
+    best_other_scores = scores[np.arange(len(student_concepts)), best_other]
+    best_student_scores = scores.max(axis=0)
+
+    matches = [
+        {
+            "concept": student_concepts[i],
+            "matched_concept": other_concepts[best_other[i]],
+            "score": round(float(best_other_scores[i]), 4),
+        }
+        for i in np.flatnonzero(best_other_scores >= sim_threshold)
+    ]
+    return {
+        "common_concepts": [match["concept"] for match in matches],
+        "common_concept_matches": matches,
+        "missing_concepts": [other_concepts[j] for j in np.flatnonzero(best_student_scores < sim_threshold)],
+        "extra_concepts": [student_concepts[i] for i in np.flatnonzero(best_other_scores < sim_threshold)],
+    }
+
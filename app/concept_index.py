@@ -0,0 +1,307 @@
+import asyncio
+import os
+import zlib
+from typing import Any, Dict, List, Optional
+from urllib.parse import unquote
+
+from bson.errors import InvalidDocument
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+from app.cache import TTLCache
+from app.concept_tasks import content_version, phrase_statistics_batch
+from app.extract import (
+    add_phrase_statistics,
+    combine_phrase_statistics,
+    extract_key_concepts,
+    extract_key_concepts_from_statistics,
+    phrase_statistics,
+    split_text_chunks,
+)
+from app.workers import EXTRACTION_WORKERS, run_in_pool
+
+# Per-note RAKE statistics, one document per (class_id, user_id).
+NOTE_STATS_COLLECTION = "note_concept_stats"
+# Aggregate RAKE statistics for every note in a class, spread over CLASS_INDEX_BUCKETS
+# documents per class_id plus a header document (bucket -1) with note_count and text_length.
+CLASS_INDEX_COLLECTION = "class_concept_buckets"
+# Monotonic content version per class, bumped on every note submission.
+CLASS_VERSIONS_COLLECTION = "class_versions"
+
+STATISTIC_FIELDS = ("phrases", "frequency", "degree")
+
+# Documents each class's statistics are hashed over. Statistics grow with the class's total
+# note text, and one document per class passes MongoDB's 16MB limit for PDF-heavy classes.
+CLASS_INDEX_BUCKETS = max(1, int(os.getenv("CLASS_INDEX_BUCKETS", "32")))
+_HEADER_BUCKET = -1
+
+# Decoded class indexes kept per (class_id, class version). Fetching and decoding every
+# bucket is O(class) work on the event loop; a version bump makes older entries unreachable.
+CLASS_INDEX_CACHE_SIZE = int(os.getenv("CLASS_INDEX_CACHE_SIZE", "32"))
+_decoded_indexes = TTLCache(maxsize=CLASS_INDEX_CACHE_SIZE)
+
+# Characters per chunk for map-reduce extraction over large texts.
+EXTRACTION_CHUNK_SIZE = int(os.getenv("EXTRACTION_CHUNK_SIZE", "20000"))
+
+
+# Phrases and words become Mongo field names, which may not contain '.', '$' or NUL.
+def _encode_key(key: str) -> str:
+    return key.replace("%", "%25").replace(".", "%2E").replace("$", "%24").replace("\x00", "%00")
+
+
+def _encode_statistics(statistics: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+    return {
+        field: {_encode_key(key): count for key, count in statistics.get(field, {}).items()}
+        for field in STATISTIC_FIELDS
+    }
+
+
+def _decode_statistics(doc: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+    return {
+        field: {unquote(key): count for key, count in (doc.get(field) or {}).items() if count > 0}
+        for field in STATISTIC_FIELDS
+    }
+
+
+def _bucket_of(encoded_key: str) -> int:
+    # crc32 rather than hash(): the mapping must be the same in every process.
+    return zlib.crc32(encoded_key.encode("utf-8")) % CLASS_INDEX_BUCKETS
+
+
+def _split_into_buckets(encoded: Dict[str, Dict[str, int]]) -> Dict[int, Dict[str, Dict[str, int]]]:
+    buckets: Dict[int, Dict[str, Dict[str, int]]] = {
+        bucket: {field: {} for field in STATISTIC_FIELDS} for bucket in range(CLASS_INDEX_BUCKETS)
+    }
+    for field in STATISTIC_FIELDS:
+        for key, count in encoded.get(field, {}).items():
+            buckets[_bucket_of(key)][field][key] = count
+    return buckets
+
+
+async def phrase_statistics_chunked(text: str, chunk_size: int = EXTRACTION_CHUNK_SIZE) -> Dict[str, Dict[str, int]]:
+    """
+    Map-reduce version of phrase_statistics for large texts. Sentence-aligned chunks are
+    scored in the extraction pool, EXTRACTION_WORKERS at a time, and folded into a single
+    accumulator as each window finishes, so peak memory is a window of chunks plus the
+    merged statistics regardless of how long the text is.
+    """
+    total: Dict[str, Dict[str, int]] = {field: {} for field in STATISTIC_FIELDS}
+    window: List[str] = []
+
+    async def flush():
+        for statistics in await asyncio.gather(*(run_in_pool(phrase_statistics, chunk) for chunk in window)):
+            add_phrase_statistics(total, statistics)
+        window.clear()
+
+    for chunk in split_text_chunks(text, chunk_size):
+        window.append(chunk)
+        if len(window) >= EXTRACTION_WORKERS:
+            await flush()
+    if window:
+        await flush()
+    return total
+
+
+async def extract_key_concepts_chunked(
+    text: str,
+    num_concepts: Optional[int] = 10,
+    threshold: float = 0.75,
+    similarity_method: str = 'string',
+    class_size: int = 1,
+    chunk_size: int = EXTRACTION_CHUNK_SIZE
+) -> List[str]:
+    """
+    extract_key_concepts for texts of any size: texts up to `chunk_size` run as a single
+    pool task, larger ones go through phrase_statistics_chunked and produce the same
+    ranking a single RAKE pass would.
+    """
+    if len(text) <= chunk_size:
+        return await run_in_pool(extract_key_concepts, text, num_concepts, threshold, similarity_method, class_size)
+    statistics = await phrase_statistics_chunked(text, chunk_size)
+    return await run_in_pool(
+        extract_key_concepts_from_statistics,
+        statistics, len(text), num_concepts, threshold, similarity_method, class_size
+    )
+
+
+def _note_stats_doc(class_id: str, user_id: str, text: str, statistics: Dict[str, Dict[str, int]]) -> Dict[str, Any]:
+    return {
+        "class_id": class_id,
+        "user_id": user_id,
+        "text_length": len(text),
+        "content_version": content_version(text),
+        **_encode_statistics(statistics),
+    }
+
+
+async def record_note_statistics(db, class_id: str, user_id: str, text: str, statistics: Dict[str, Dict[str, int]]) -> None:
+    """
+    Store the RAKE statistics of a submitted note and apply the difference from the
+    previous version of that note to the class index. Work is proportional to the note,
+    not the class.
+    """
+    new_doc = _note_stats_doc(class_id, user_id, text, statistics)
+    previous = await db[NOTE_STATS_COLLECTION].find_one_and_replace(
+        {"class_id": class_id, "user_id": user_id},
+        new_doc,
+        upsert=True
+    )
+
+    header: Dict[str, int] = {"text_length": new_doc["text_length"]}
+    if previous is None:
+        header["note_count"] = 1
+    else:
+        header["text_length"] -= previous.get("text_length", 0)
+    increments: Dict[int, Dict[str, int]] = {}
+    for field in STATISTIC_FIELDS:
+        for key, count in new_doc[field].items():
+            bucket = increments.setdefault(_bucket_of(key), {})
+            bucket[f"{field}.{key}"] = bucket.get(f"{field}.{key}", 0) + count
+        if previous is not None:
+            for key, count in (previous.get(field) or {}).items():
+                bucket = increments.setdefault(_bucket_of(key), {})
+                bucket[f"{field}.{key}"] = bucket.get(f"{field}.{key}", 0) - count
+
+    operations = []
+    for bucket, deltas in increments.items():
+        deltas = {path: delta for path, delta in deltas.items() if delta}
+        if deltas:
+            operations.append(UpdateOne({"class_id": class_id, "bucket": bucket}, {"$inc": deltas}, upsert=True))
+    operations.append(UpdateOne(
+        {"class_id": class_id, "bucket": _HEADER_BUCKET},
+        {"$inc": header, "$setOnInsert": {"buckets": CLASS_INDEX_BUCKETS}},
+        upsert=True
+    ))
+    await db[CLASS_INDEX_COLLECTION].bulk_write(operations, ordered=False)
+
+
+async def invalidate_class_index(db, class_id: str) -> None:
+    """
+    Drop the class index so the next read rebuilds it from the notes.
+    """
+    await db[CLASS_INDEX_COLLECTION].delete_many({"class_id": class_id})
+
+
+async def rebuild_class_index(db, class_id: str) -> Dict[str, Any]:
+    """
+    Rebuild the class index from the class notes, computing statistics only for notes
+    whose stored statistics are missing or belong to an older version of the content.
+    Statistics that cannot be stored are still returned, computed on the fly.
+    """
+    notes = await db.notes.find({"class_id": class_id}, {"user_id": 1, "content": 1}).to_list(length=None)
+    stored = {
+        doc["user_id"]: doc
+        for doc in await db[NOTE_STATS_COLLECTION].find({"class_id": class_id}).to_list(length=None)
+    }
+
+    stale = [
+        note for note in notes
+        if stored.get(note["user_id"], {}).get("content_version") != content_version(note.get("content", ""))
+    ]
+    if stale:
+        print(f"Computing concept statistics for {len(stale)} notes in class {class_id}")
+        computed = await run_in_pool(phrase_statistics_batch, [note.get("content", "") for note in stale])
+        for note, statistics in zip(stale, computed):
+            doc = _note_stats_doc(class_id, note["user_id"], note.get("content", ""), statistics)
+            try:
+                await db[NOTE_STATS_COLLECTION].replace_one(
+                    {"class_id": class_id, "user_id": note["user_id"]}, doc, upsert=True
+                )
+            except (PyMongoError, InvalidDocument) as e:
+                print(f"Could not store concept statistics for user {note['user_id']} in class {class_id}: {e}")
+            stored[note["user_id"]] = doc
+
+    total: Dict[str, Dict[str, int]] = {field: {} for field in STATISTIC_FIELDS}
+    text_length = 0
+    for note in notes:
+        doc = stored[note["user_id"]]
+        add_phrase_statistics(total, _decode_statistics(doc))
+        text_length += doc.get("text_length", 0)
+
+    index = {"class_id": class_id, "note_count": len(notes), "text_length": text_length}
+    operations = [
+        ReplaceOne({"class_id": class_id, "bucket": bucket}, {"class_id": class_id, "bucket": bucket, **fields}, upsert=True)
+        for bucket, fields in _split_into_buckets(_encode_statistics(total)).items()
+    ]
+    # The header goes last: readers treat the index as missing until it is written.
+    operations.append(ReplaceOne(
+        {"class_id": class_id, "bucket": _HEADER_BUCKET},
+        {**index, "bucket": _HEADER_BUCKET, "buckets": CLASS_INDEX_BUCKETS},
+        upsert=True
+    ))
+    try:
+        await db[CLASS_INDEX_COLLECTION].delete_many({"class_id": class_id, "bucket": _HEADER_BUCKET})
+        await db[CLASS_INDEX_COLLECTION].bulk_write(operations, ordered=True)
+    except (PyMongoError, InvalidDocument) as e:
+        print(f"Could not store the concept index of class {class_id}, serving statistics computed on the fly: {e}")
+        await invalidate_class_index(db, class_id)
+    return {**index, "statistics": total}
+
+
+async def load_class_index(db, class_id: str) -> Dict[str, Any]:
+    """
+    Return the class index as {"note_count", "text_length", "statistics"}, rebuilding it
+    when it is missing or does not cover every note in the class. The decoded index is
+    cached under the class version, which is read first: the version is bumped after the
+    index is updated, so an entry is never older than its key. Callers must not modify it.
+    """
+    cache_key = (class_id, await get_class_version(db, class_id))
+    cached = _decoded_indexes.get(cache_key)
+    if cached is not None:
+        return cached
+
+    docs = await db[CLASS_INDEX_COLLECTION].find({"class_id": class_id}).to_list(length=None)
+    doc = next((doc for doc in docs if doc.get("bucket") == _HEADER_BUCKET), None)
+    note_count = await db.notes.count_documents({"class_id": class_id})
+    if doc is None or doc.get("buckets") != CLASS_INDEX_BUCKETS or doc.get("note_count", 0) != note_count:
+        index = await rebuild_class_index(db, class_id)
+    else:
+        statistics: Dict[str, Dict[str, int]] = {field: {} for field in STATISTIC_FIELDS}
+        for bucket in docs:
+            if bucket.get("bucket") != _HEADER_BUCKET:
+                for field, counts in _decode_statistics(bucket).items():
+                    statistics[field].update(counts)
+        index = {
+            "class_id": class_id,
+            "note_count": doc.get("note_count", 0),
+            "text_length": doc.get("text_length", 0),
+            "statistics": statistics,
+        }
+    _decoded_indexes.set(cache_key, index)
+    return index
+
+
+async def class_statistics_excluding(db, class_id: str, user_id: str) -> Dict[str, Any]:
+    """
+    Statistics for every note in the class except `user_id`'s, derived from the class
+    index by subtracting that one note. "text_length" is the length of the other notes
+    joined with single spaces, matching the aggregated text the endpoints used to build.
+    """
+    index = await load_class_index(db, class_id)
+    statistics = index["statistics"]
+    note_count = index["note_count"]
+    text_length = index["text_length"]
+
+    own: Optional[Dict[str, Any]] = await db[NOTE_STATS_COLLECTION].find_one({"class_id": class_id, "user_id": user_id})
+    if own is not None:
+        statistics = combine_phrase_statistics(statistics, _decode_statistics(own), sign=-1)
+        note_count -= 1
+        text_length -= own.get("text_length", 0)
+
+    return {
+        "note_count": note_count,
+        "text_length": text_length + max(0, note_count - 1),
+        "statistics": statistics,
+    }
+
+
+async def bump_class_version(db, class_id: str) -> None:
+    """
+    Mark the class content as changed, invalidating results cached under the old version.
+    """
+    await db[CLASS_VERSIONS_COLLECTION].update_one({"class_id": class_id}, {"$inc": {"version": 1}}, upsert=True)
+
+
+async def get_class_version(db, class_id: str) -> int:
+    doc = await db[CLASS_VERSIONS_COLLECTION].find_one({"class_id": class_id}, {"version": 1})
+    return (doc or {}).get("version", 0)
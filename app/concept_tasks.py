@@ -0,0 +1,75 @@
+import hashlib
+import os
+from typing import Any, Dict, List
+
+import numpy as np
+
+from app.embeddings import encode_phrases
+from app.extract import calculate_effective_threshold, extract_key_concepts, phrase_statistics
+
+# Per-student extraction functions run in the extraction process pool. Like app.compare they
+# live outside app.precompute and the route modules, so that pool workers do not import
+# FastAPI, the database or the vector index.
+
+# Lobby defaults, mirroring the advanced_settings created in app.routes.lobby.
+DEFAULT_SIMILARITY_THRESHOLD = 0.75
+DEFAULT_SIMILARITY_METHOD = "string"
+# Concepts extracted, embedded and stored per student. Every num_concepts the app asks for
+# is served by slicing this list, so keep it at or above the lobby settings' maximum (50).
+PRECOMPUTE_MAX_CONCEPTS = max(1, int(os.getenv("PRECOMPUTE_MAX_CONCEPTS", "200")))
+
+
+def content_version(text: str) -> str:
+    """
+    Stable version identifier for a note's content.
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def compute_student_concepts(
+    text: str,
+    threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+    similarity_method: str = DEFAULT_SIMILARITY_METHOD,
+    class_size: int = 1,
+    with_embeddings: bool = False
+) -> Dict[str, Any]:
+    """
+    Extract the top PRECOMPUTE_MAX_CONCEPTS deduplicated concepts for a student's text, so
+    any num_concepts up to that can later be served by slicing. With `with_embeddings`,
+    "concept_embeddings" holds their float32 embeddings.
+    """
+    all_concepts = extract_key_concepts(text, PRECOMPUTE_MAX_CONCEPTS, threshold, similarity_method, class_size)
+    result = {
+        "all_concepts": all_concepts,
+        "content_version": content_version(text),
+        "similarity_method": similarity_method,
+        "effective_threshold": calculate_effective_threshold(len(text), threshold, class_size),
+    }
+    if with_embeddings:
+        result["concept_embeddings"] = encode_phrases(all_concepts)
+    return result
+
+
+def compute_student_concepts_batch(
+    texts: List[str],
+    threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+    similarity_method: str = DEFAULT_SIMILARITY_METHOD
+) -> List[Dict[str, Any]]:
+    """
+    compute_student_concepts for several students in one pool task.
+    """
+    return [compute_student_concepts(text, threshold, similarity_method) for text in texts]
+
+
+def embed_concepts(concepts: List[str]) -> np.ndarray:
+    """
+    Embed a list of concepts in one batched pass, as a float32 array.
+    """
+    return encode_phrases(concepts)
+
+
+def phrase_statistics_batch(texts: List[str]) -> List[Dict[str, Dict[str, int]]]:
+    """
+    phrase_statistics for several notes in one pool task.
+    """
+    return [phrase_statistics(text) for text in texts]
@@ -0,0 +1,172 @@
+import heapq
+import math
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+# Approximate token budget for each block of notes placed in a Gemini prompt.
+CONDENSE_TOKEN_BUDGET = int(os.getenv("CONDENSE_TOKEN_BUDGET", "600"))
+# Share of a word's weight left once a selected sentence has covered it, so later picks
+# favour concepts that are not represented yet.
+COVERED_WEIGHT = 0.3
+# Sentences sharing at least this fraction of their words with a chosen one are skipped.
+REDUNDANCY_THRESHOLD = 0.8
+
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count for Gemini (about four characters per token for English text).
+    """
+    return math.ceil(len(text) / 4)
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+
+def _split_oversized(sentence: str, token_budget: int) -> List[str]:
+    """
+    Cut a sentence that alone exceeds `token_budget` into consecutive word windows that
+    each fit it. Notes without sentence punctuation (e.g. typed bullet lists) arrive here
+    as one long "sentence".
+    """
+    if estimate_tokens(sentence) <= token_budget:
+        return [sentence]
+    max_chars = max(1, token_budget * 4)
+    windows: List[str] = []
+    current: List[str] = []
+    length = 0
+    for word in sentence.split():
+        # A single word longer than the whole budget is truncated.
+        word = word[:max_chars]
+        if current and length + 1 + len(word) > max_chars:
+            windows.append(" ".join(current))
+            current, length = [], 0
+        length += len(word) + (1 if current else 0)
+        current.append(word)
+    if current:
+        windows.append(" ".join(current))
+    return windows
+
+
+def _concept_word_weights(concepts: List[str]) -> Dict[str, float]:
+    """
+    Weight each word of the ranked concepts by the rank of the best concept containing it.
+    """
+    weights: Dict[str, float] = {}
+    for rank, concept in enumerate(concepts):
+        for word in _WORD.findall(concept.lower()):
+            if len(word) > 2:
+                weights[word] = max(weights.get(word, 0.0), 1.0 / (1 + rank))
+    return weights
+
+
+def condense_text(text: str, concepts: List[str], token_budget: int = CONDENSE_TOKEN_BUDGET) -> Tuple[str, Dict[str, Any]]:
+    """
+    Pick the sentences of `text` that best cover the ranked `concepts` within
+    `token_budget`, returned in their original order together with size statistics.
+
+    Sentences longer than the budget are first cut into word windows, so non-empty text
+    never condenses to an empty string.
+
+    Selection is greedy weighted coverage per token: a sentence's gain is the weight of the
+    concept words it contains, and words already covered by a chosen sentence keep only
+    COVERED_WEIGHT of their weight so later picks favour concepts not represented yet, and
+    sentences that mostly repeat a chosen one are skipped. Gains only shrink as sentences
+    are chosen, so stale heap entries are re-scored lazily.
+    """
+    original_tokens = estimate_tokens(text)
+    if original_tokens <= token_budget:
+        sentences = split_sentences(text)
+        return text, {
+            "original_tokens": original_tokens,
+            "sentences_total": len(sentences),
+            "condensed_tokens": original_tokens,
+            "tokens_saved": 0,
+            "sentences_kept": len(sentences),
+        }
+
+    sentences = [window for sentence in split_sentences(text) for window in _split_oversized(sentence, token_budget)]
+    stats = {
+        "original_tokens": original_tokens,
+        "sentences_total": len(sentences),
+    }
+
+    weights = _concept_word_weights(concepts)
+    all_words = [set(_WORD.findall(sentence.lower())) for sentence in sentences]
+    sentence_words = [words & weights.keys() for words in all_words]
+    costs = [max(1, estimate_tokens(sentence)) for sentence in sentences]
+    remaining = dict(weights)
+
+    def gain(i: int) -> float:
+        return sum(remaining[word] for word in sentence_words[i]) / costs[i]
+
+    heap = [(-gain(i), i) for i in range(len(sentences)) if sentence_words[i]]
+    heapq.heapify(heap)
+    chosen = []
+    used = 0
+    while heap:
+        negative_gain, i = heapq.heappop(heap)
+        current = gain(i)
+        if current <= 0:
+            continue
+        if heap and current < -heap[0][0] and -negative_gain != current:
+            heapq.heappush(heap, (-current, i))
+            continue
+        if used + costs[i] > token_budget:
+            continue
+        if any(
+            len(all_words[i] & all_words[j]) >= REDUNDANCY_THRESHOLD * len(all_words[i] | all_words[j])
+            for j in chosen
+        ):
+            continue
+        chosen.append(i)
+        used += costs[i]
+        for word in sentence_words[i]:
+            remaining[word] *= COVERED_WEIGHT
+
+    # Without concept matches, fall back to the leading sentences.
+    if not chosen:
+        for i, cost in enumerate(costs):
+            if used + cost > token_budget:
+                break
+            chosen.append(i)
+            used += cost
+
+    condensed = " ".join(sentences[i] for i in sorted(chosen))
+    condensed_tokens = estimate_tokens(condensed)
+    return condensed, {
+        **stats,
+        "condensed_tokens": condensed_tokens,
+        "tokens_saved": original_tokens - condensed_tokens,
+        "sentences_kept": len(chosen),
+    }
+
+
+def condense_note_blocks(
+    student_content: str,
+    other_content: str,
+    student_concepts: List[str],
+    other_concepts: List[str],
+    token_budget: int = CONDENSE_TOKEN_BUDGET
+) -> Dict[str, Any]:
+    """
+    Condense the student's notes and the classmates' notes for the detailed analysis
+    prompt. Each block is ranked by its own concepts first and the other side's second.
+    Runs in the extraction pool.
+    """
+    student_condensed, student_stats = condense_text(student_content, student_concepts + other_concepts, token_budget)
+    other_condensed, other_stats = condense_text(other_content, other_concepts + student_concepts, token_budget)
+    return {
+        "student_content": student_condensed,
+        "other_content": other_condensed,
+        "stats": {
+            "token_budget": token_budget,
+            "student": student_stats,
+            "others": other_stats,
+            "tokens_saved": student_stats["tokens_saved"] + other_stats["tokens_saved"],
+        },
+    }
@@ -1,33 +1,117 @@
 import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from bson.objectid import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
 from fastapi import HTTPException
 from contextlib import asynccontextmanager
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import PyMongoError
+from app.pagination import PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, fetch_page
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 
 # Create a single client instance
 client = AsyncIOMotorClient(MONGODB_URL)
 
+# Every index the application relies on, created once by ensure_indexes() at startup.
+# Each entry: database, collection, key fields and index options.
+INDEX_SPECS: List[Dict[str, Any]] = [
+    {"database": "auth_db", "collection": "users", "keys": [("username", ASCENDING)], "options": {"unique": True}},
+    {"database": "auth_db", "collection": "users", "keys": [("email", ASCENDING)], "options": {"unique": True}},
+    {"database": "notes_db", "collection": "notes", "keys": [("title", ASCENDING)], "options": {}},
+    {"database": "notes_db", "collection": "notes", "keys": [("created_at", ASCENDING)], "options": {}},
+    {"database": "notes_db", "collection": "notes", "keys": [("user_id", ASCENDING)], "options": {}},
+    # One note per student per class (submit-note upserts on it); also serves the
+    # {class_id}, {class_id, user_id} and {class_id, user_id: {$ne}} lookups.
+    {"database": "notes_db", "collection": "notes",
+     "keys": [("class_id", ASCENDING), ("user_id", ASCENDING)], "options": {"unique": True}},
+    {"database": "notes_db", "collection": "student_concepts",
+     "keys": [("class_id", ASCENDING), ("user_id", ASCENDING)], "options": {"unique": True}},
+    # Incremental vector index refresh: {class_id, updated_at: {$gte}}.
+    {"database": "notes_db", "collection": "student_concepts",
+     "keys": [("class_id", ASCENDING), ("updated_at", ASCENDING)], "options": {}},
+    {"database": "notes_db", "collection": "note_concept_stats",
+     "keys": [("class_id", ASCENDING), ("user_id", ASCENDING)], "options": {"unique": True}},
+    {"database": "notes_db", "collection": "class_concept_buckets",
+     "keys": [("class_id", ASCENDING), ("bucket", ASCENDING)], "options": {"unique": True}},
+    {"database": "notes_db", "collection": "class_versions", "keys": [("class_id", ASCENDING)], "options": {"unique": True}},
+    {"database": "notes_db", "collection": "analysis_jobs",
+     "keys": [("user_id", ASCENDING), ("class_id", ASCENDING), ("class_version", ASCENDING)], "options": {"unique": True}},
+    # Resuming queued jobs at startup.
+    {"database": "notes_db", "collection": "analysis_jobs", "keys": [("status", ASCENDING)], "options": {}},
+    # Keyset pagination of the lobby list.
+    {"database": "notes_db", "collection": "lobbies",
+     "keys": [("created_at", ASCENDING), ("_id", ASCENDING)], "options": {}},
+    # Newest updated_at for the lobby list's ETag probe.
+    {"database": "notes_db", "collection": "lobbies", "keys": [("updated_at", ASCENDING)], "options": {}},
+]
+
+
+async def ensure_indexes(db_client: Optional[AsyncIOMotorClient] = None) -> Dict[str, Any]:
+    """
+    Create the indexes declared in INDEX_SPECS that do not exist yet. Each index is
+    created on its own, so one that cannot be built (e.g. a unique index over existing
+    duplicates) is reported without blocking the others.
+    """
+    db_client = db_client or client
+    report: Dict[str, Any] = {"indexes": [], "errors": {}}
+    for spec in INDEX_SPECS:
+        collection = db_client[spec["database"]][spec["collection"]]
+        model = IndexModel(spec["keys"], **spec["options"])
+        name = f"{spec['database']}.{spec['collection']}.{model.document['name']}"
+        try:
+            await collection.create_indexes([model])
+            report["indexes"].append(name)
+        except PyMongoError as e:
+            print(f"Could not create index {name}: {e}")
+            report["errors"][name] = str(e)
+    print(f"Ensured {len(report['indexes'])} indexes, {len(report['errors'])} failed")
+    return report
+
+
 @asynccontextmanager
 async def get_database_client():
     try:
-        # Initialize auth_db indexes if they don't exist
-        await client.auth_db.users.create_index("username", unique=True)
-        await client.auth_db.users.create_index("email", unique=True)
-        
-        # Initialize notes_db indexes if they don't exist
-        await client.notes_db.notes.create_index("title")
-        await client.notes_db.notes.create_index("created_at")
-        await client.notes_db.notes.create_index("user_id")
-        
         yield client
+    except HTTPException:
+        # Errors the endpoint raised on purpose keep their status code.
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-async def fetch_all_notes(db_client: AsyncIOMotorClient):
+async def fetch_notes_page(
+    db_client: AsyncIOMotorClient,
+    limit: int = PAGE_SIZE_DEFAULT,
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    projection: Optional[Dict[str, Any]] = None
+):
+    """
+    One page of notes in _id order, optionally only those created after `since` and with
+    only the `projection` fields. Returns (notes, next_cursor); next_cursor is None on the
+    last page.
+    """
     try:
         db = db_client.notes_db
-        cursor = db.notes.find({})
-        return await cursor.to_list(length=None)
-    except Exception as e:
+        query = {"_id": {"$gt": ObjectId.from_datetime(since)}} if since is not None else {}
+        return await fetch_page(db.notes, query, projection, limit, cursor)
+    except PyMongoError:
         raise HTTPException(status_code=500, detail="Failed to fetch notes from the database.")
+
+async def fetch_all_notes(
+    db_client: AsyncIOMotorClient,
+    since: Optional[datetime] = None,
+    projection: Optional[Dict[str, Any]] = None,
+    batch_size: int = PAGE_SIZE_MAX
+):
+    """
+    Yield every note page by page, so only one page is held in memory at a time.
+    """
+    cursor = None
+    while True:
+        notes, cursor = await fetch_notes_page(db_client, batch_size, cursor, since, projection)
+        for note in notes:
+            yield note
+        if cursor is None:
+            return
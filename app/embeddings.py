@@ -0,0 +1,276 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from bson import Binary
+
+from app.cache import TTLCache
+
+# Name of the sentence-transformers model shared by extraction and concept comparison.
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "paraphrase-MiniLM-L6-v2")
+# "torch" (default) or "onnx" for the int8-quantized CPU backend.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Quantized weights shipped in the model repository; pick the variant matching the CPU.
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+# Directory with pre-downloaded model weights (sentence-transformers cache_folder).
+EMBEDDING_MODEL_CACHE = os.getenv("EMBEDDING_MODEL_CACHE")
+# Set to 1 to load weights only from the local cache and never touch the network.
+EMBEDDING_OFFLINE = os.getenv("EMBEDDING_OFFLINE", "0") == "1"
+
+# Number of phrase embeddings kept in the in-memory LRU tier (384 floats each).
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "50000"))
+# Optional SQLite file for the on-disk tier; shared by every worker process on the host.
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+
+# One model per (name, backend) for the whole process.
+_models: Dict[Tuple[str, str], object] = {}
+_models_lock = threading.Lock()
+
+_memory_cache = TTLCache(maxsize=EMBEDDING_CACHE_SIZE)
+_disk_connection: Optional[sqlite3.Connection] = None
+_disk_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_cache_stats = {
+    "memory_hits": 0,
+    "disk_hits": 0,
+    "misses": 0,
+    "encode_batches": 0,
+    # Forward passes batched semantic dedup avoided compared with encoding pair by pair.
+    "dedup_forward_passes_saved": 0,
+}
+# In the API process: memory tier size last reported by each pool worker, by pid.
+_worker_entries: Dict[int, int] = {}
+
+
+def _load_model(name: str, backend: str):
+    """
+    Construct a SentenceTransformer for the requested backend.
+    The ONNX backend needs sentence-transformers>=3.2 with optimum[onnxruntime]; if it
+    cannot be loaded we fall back to the default torch backend.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    kwargs = {"cache_folder": EMBEDDING_MODEL_CACHE}
+    if EMBEDDING_OFFLINE:
+        kwargs["local_files_only"] = True
+    if backend == "onnx":
+        try:
+            return SentenceTransformer(name, backend="onnx", model_kwargs={"file_name": EMBEDDING_ONNX_FILE}, **kwargs)
+        except Exception as e:
+            print(f"Failed to load ONNX backend for {name}, falling back to torch: {e}")
+    return SentenceTransformer(name, **kwargs)
+
+
+def get_embedding_model(name: str = EMBEDDING_MODEL_NAME, backend: str = EMBEDDING_BACKEND):
+    """
+    Return the process-wide embedding model, loading it on first use.
+    """
+    key = (name, backend)
+    model = _models.get(key)
+    if model is None:
+        with _models_lock:
+            model = _models.get(key)
+            if model is None:
+                print(f"Loading embedding model {name} ({backend} backend)")
+                model = _load_model(name, backend)
+                _models[key] = model
+    return model
+
+
+def cosine_similarity_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Pairwise cosine similarity between the rows of `a` and `b`, computed in NumPy so that
+    comparing embeddings does not require importing torch.
+    """
+    a = np.atleast_2d(np.asarray(a, dtype=np.float32))
+    b = np.atleast_2d(np.asarray(b, dtype=np.float32))
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return a @ b.T
+
+
+def pack_embeddings(vectors: np.ndarray) -> Binary:
+    """
+    Embeddings as a single float32 BSON Binary for storage: 4 bytes per dimension, where a
+    BSON array of doubles takes about 16 (8-byte value plus its index key).
+    """
+    return Binary(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+
+
+def unpack_embeddings(value, count: int) -> Optional[np.ndarray]:
+    """
+    Stored embeddings as a (count, dimension) float32 array, read from pack_embeddings
+    output or from the lists of floats stored by earlier versions. None if they do not
+    hold `count` vectors.
+    """
+    if isinstance(value, bytes):
+        flat = np.frombuffer(value, dtype=np.float32)
+    else:
+        flat = np.asarray(value if value is not None else [], dtype=np.float32).ravel()
+    if count <= 0 or flat.size == 0 or flat.size % count:
+        return None
+    return flat.reshape(count, -1)
+
+
+# -------------------------------------------------------------------
+# Phrase embedding cache: in-memory LRU in front of an optional SQLite tier.
+def _model_key() -> str:
+    return f"{EMBEDDING_MODEL_NAME}:{EMBEDDING_BACKEND}"
+
+
+def _phrase_key(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _get_disk_connection() -> Optional[sqlite3.Connection]:
+    global _disk_connection
+    if not EMBEDDING_CACHE_PATH:
+        return None
+    if _disk_connection is None:
+        connection = sqlite3.connect(EMBEDDING_CACHE_PATH, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, phrase_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, phrase_hash))"
+        )
+        connection.commit()
+        _disk_connection = connection
+    return _disk_connection
+
+
+def _disk_get(keys: List[str]) -> Dict[str, np.ndarray]:
+    found: Dict[str, np.ndarray] = {}
+    with _disk_lock:
+        connection = _get_disk_connection()
+        if connection is None or not keys:
+            return found
+        # Stay well below SQLite's bound-parameter limit.
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT phrase_hash, vector FROM embeddings WHERE model = ? AND phrase_hash IN ({placeholders})",
+                [_model_key(), *chunk]
+            )
+            for phrase_hash, vector in rows:
+                found[phrase_hash] = np.frombuffer(vector, dtype=np.float32)
+    return found
+
+
+def _disk_set(entries: Dict[str, np.ndarray]) -> None:
+    with _disk_lock:
+        connection = _get_disk_connection()
+        if connection is None or not entries:
+            return
+        connection.executemany(
+            "INSERT OR IGNORE INTO embeddings (model, phrase_hash, vector) VALUES (?, ?, ?)",
+            [(_model_key(), key, vector.astype(np.float32).tobytes()) for key, vector in entries.items()]
+        )
+        connection.commit()
+
+
+def _count(name: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _cache_stats[name] += amount
+
+
+def encode_phrases_counted(phrases: List[str]) -> Tuple[np.ndarray, int]:
+    """
+    encode_phrases, also returning the number of model forward passes it ran: 1 when
+    some phrase missed the cache, 0 when all of them were cached.
+    """
+    from app.extract import normalize_phrase
+
+    normalized = [normalize_phrase(phrase) for phrase in phrases]
+    keys = [_phrase_key(text) for text in normalized]
+    vectors: Dict[str, np.ndarray] = {}
+
+    for key in set(keys):
+        vector = _memory_cache.get((_model_key(), key))
+        if vector is not None:
+            vectors[key] = vector
+    _count("memory_hits", len(vectors))
+
+    pending = [key for key in dict.fromkeys(keys) if key not in vectors]
+    from_disk = _disk_get(pending)
+    for key, vector in from_disk.items():
+        vectors[key] = vector
+        _memory_cache.set((_model_key(), key), vector)
+    _count("disk_hits", len(from_disk))
+
+    misses = {key: text for key, text in zip(keys, normalized) if key not in vectors}
+    forward_passes = 1 if misses else 0
+    if misses:
+        _count("misses", len(misses))
+        _count("encode_batches")
+        encoded = get_embedding_model().encode(list(misses.values()), convert_to_numpy=True)
+        new_entries = {}
+        for key, vector in zip(misses.keys(), encoded):
+            vector = np.asarray(vector, dtype=np.float32)
+            vectors[key] = vector
+            new_entries[key] = vector
+            _memory_cache.set((_model_key(), key), vector)
+        _disk_set(new_entries)
+
+    if not keys:
+        dimension = get_embedding_model().get_sentence_embedding_dimension()
+        return np.zeros((0, dimension), dtype=np.float32), forward_passes
+    return np.vstack([vectors[key] for key in keys]), forward_passes
+
+
+def encode_phrases(phrases: List[str]) -> np.ndarray:
+    """
+    Embed phrases through the cache and return a float32 array with one row per phrase.
+    Entries are keyed by (model, hash of the normalized phrase) and the normalized text is
+    what gets encoded, so every surface form of a phrase shares one embedding.
+    Only cache misses are sent to the model, in a single batch.
+    """
+    return encode_phrases_counted(phrases)[0]
+
+
+def record_dedup_passes_saved(amount: int) -> None:
+    """
+    Count forward passes saved by batched semantic dedup in the embedding stats.
+    """
+    _count("dedup_forward_passes_saved", amount)
+
+
+def run_counting_cache_stats(fn, *args, **kwargs):
+    """
+    Run `fn` in a pool worker and return (result, report), where the report holds the cache
+    counters the worker gathered since its last report, for record_worker_cache_stats.
+    """
+    result = fn(*args, **kwargs)
+    with _stats_lock:
+        counts = dict(_cache_stats)
+        for name in _cache_stats:
+            _cache_stats[name] = 0
+    return result, {"pid": os.getpid(), "counts": counts, "memory_entries": len(_memory_cache)}
+
+
+def record_worker_cache_stats(report: Dict[str, object]) -> None:
+    with _stats_lock:
+        for name, amount in report["counts"].items():
+            _cache_stats[name] += amount
+        _worker_entries[report["pid"]] = report["memory_entries"]
+
+
+def embedding_cache_stats() -> Dict[str, object]:
+    """
+    Hit/miss counters for the embedding cache of this process and of the extraction pool
+    workers that have reported back, used to size the tiers.
+    """
+    with _stats_lock:
+        stats = dict(_cache_stats)
+        worker_entries = dict(_worker_entries)
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+    stats["memory_entries"] = len(_memory_cache) + sum(worker_entries.values())
+    stats["workers_reporting"] = len(worker_entries)
+    stats["memory_capacity"] = EMBEDDING_CACHE_SIZE
+    stats["disk_enabled"] = bool(EMBEDDING_CACHE_PATH)
+    return stats
@@ -1,17 +1,82 @@
+import math
+import os
 import re
-from typing import List
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional
 from difflib import SequenceMatcher
-from rake_nltk import Rake
-from nltk.corpus import stopwords
-from sentence_transformers import SentenceTransformer, util
-import nltk
+import numpy as np
+from app.embeddings import (
+    cosine_similarity_matrix,
+    encode_phrases,
+    encode_phrases_counted,
+    get_embedding_model,
+    record_dedup_passes_saved,
+)
 
-# Download required resources if not already present
-nltk.download('stopwords')
-nltk.download('punkt_tab')  # Downloads additional tokenizer data
+# NLTK resources RAKE needs, looked up under NLTK_DATA (e.g. a directory baked into the image).
+NLTK_RESOURCES = {"stopwords": "corpora/stopwords", "punkt_tab": "tokenizers/punkt_tab"}
+# Off by default so a missing resource fails fast instead of hitting the network at request
+# time; set to 1 to let the app download missing resources itself.
+NLTK_ALLOW_DOWNLOAD = os.getenv("NLTK_ALLOW_DOWNLOAD", "0") == "1"
 
-# Initialize the sentence transformer model once (reuse across calls)
-model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
+_rake_local = threading.local()
+
+
+class NLTKResourceMissing(RuntimeError):
+    """
+    An NLTK resource RAKE needs is not installed and NLTK_ALLOW_DOWNLOAD forbids fetching it.
+    """
+
+
+def ensure_nltk_resources() -> None:
+    """
+    Make sure the NLTK resources RAKE needs are available, downloading them only if they
+    are missing and NLTK_ALLOW_DOWNLOAD permits it.
+    """
+    import nltk
+
+    for name, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            if not NLTK_ALLOW_DOWNLOAD:
+                raise NLTKResourceMissing(f"NLTK resource '{name}' is not installed and NLTK_ALLOW_DOWNLOAD=0")
+            nltk.download(name, download_dir=os.getenv("NLTK_DATA"))
+
+
+@lru_cache(maxsize=1)
+def _english_stopwords() -> List[str]:
+    from nltk.corpus import stopwords
+
+    ensure_nltk_resources()
+    return stopwords.words('english')
+
+
+def _get_rake():
+    """
+    Return this thread's RAKE instance, built once with English stopwords from NLTK.
+    Each extraction fully resets its state, so it can be reused between calls.
+    NLTK (and its scipy imports) load here rather than when the module is imported.
+    """
+    rake = getattr(_rake_local, "rake", None)
+    if rake is None:
+        from rake_nltk import Rake
+
+        rake = Rake(stopwords=_english_stopwords())
+        _rake_local.rake = rake
+    return rake
+
+
+def warm_up() -> bool:
+    """
+    Load everything extraction needs in the current process: NLTK resources, the RAKE
+    setup and the embedding model. Used by the startup warmup of the worker pool.
+    """
+    _get_rake()
+    get_embedding_model()
+    return True
 
 
 def calculate_dynamic_threshold(text_length: int, class_size: int = 1) -> float:
@@ -28,6 +93,17 @@ def calculate_dynamic_threshold(text_length: int, class_size: int = 1) -> float:
     return min(0.85, max(0.65, dynamic_value))
 
 
+def calculate_effective_threshold(text_length: int, threshold: float, class_size: int = 1) -> float:
+    """
+    The similarity threshold extraction actually dedups with: the requested threshold,
+    capped by the dynamic threshold for this text length and class size.
+    """
+    dynamic_threshold = calculate_dynamic_threshold(text_length, class_size)
+    effective_threshold = min(threshold, dynamic_threshold)
+    print(f"Calculated dynamic threshold: {dynamic_threshold}, effective_threshold: {effective_threshold}")
+    return effective_threshold
+
+
 def normalize_phrase(text: str) -> str:
     """
     Normalize a phrase: lowercases the text and removes non-alphanumeric characters.
@@ -44,29 +120,336 @@ def is_similar(phrase_a: str, phrase_b: str, threshold: float = 0.75, method: st
     if method == 'string':
         return SequenceMatcher(None, normalize_phrase(phrase_a), normalize_phrase(phrase_b)).ratio() >= threshold
     elif method == 'semantic':
-        emb_a = model.encode(phrase_a, convert_to_tensor=True)
-        emb_b = model.encode(phrase_b, convert_to_tensor=True)
-        # Use cosine similarity from sentence-transformers utility
-        return util.pytorch_cos_sim(emb_a, emb_b).item() >= threshold
+        embeddings = encode_phrases([phrase_a, phrase_b])
+        return cosine_similarity_matrix(embeddings[:1], embeddings[1:])[0, 0] >= threshold
     else:
         raise ValueError("Unsupported similarity method")
 
 
-def filter_similar_phrases(phrases: List[str], threshold: float = 0.75, method: str = 'string') -> List[str]:
+class StringDedupIndex:
+    """
+    Candidate index for string-based dedup of normalized phrases.
+
+    SequenceMatcher.ratio() is 2*M/T, where the matches M never exceed the shorter
+    length or the characters two phrases share. Kept phrases are stored sorted by
+    normalized length, with a matrix of per-phrase character counts in the same order,
+    so a lookup bisects to the admissible length window (for threshold t, partners of a
+    length-n phrase are between t*n/(2-t) and n*(2-t)/t long) and only scans those rows.
+    Their shared-character bounds are computed in one vectorized step, and only phrases
+    whose bound reaches the threshold go through SequenceMatcher, most promising first.
+    Both bounds are the ones difflib uses for real_quick_ratio/quick_ratio, so the answer
+    is exactly the one is_similar would give. A lookup costs at most one pass over the
+    kept phrases, so with a `limit` on kept phrases a dedup is linear in its input.
+    """
+
+    def __init__(self, threshold: float = 0.75):
+        self.threshold = threshold
+        self._exact = set()
+        self._matchers: List[SequenceMatcher] = []
+        self._columns: Dict[str, int] = {}
+        # Kept phrases in ascending length order: their lengths, ids and character counts,
+        # in arrays with spare capacity so an insertion only shifts the longer phrases.
+        self._size = 0
+        self._lengths = np.zeros(64, dtype=np.int64)
+        self._ids = np.zeros(64, dtype=np.int64)
+        self._counts = np.zeros((64, 0), dtype=np.int32)
+
+    def _bound_reaches(self, shared: np.ndarray, total: np.ndarray) -> np.ndarray:
+        # Same arithmetic as SequenceMatcher.ratio(), so float rounding cannot disagree.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (total == 0) | (2.0 * shared / total >= self.threshold)
+
+    def _count_vector(self, counts: Counter) -> np.ndarray:
+        vector = np.zeros(len(self._columns), dtype=np.int32)
+        for char, count in counts.items():
+            column = self._columns.get(char)
+            # Characters no kept phrase contains cannot be shared.
+            if column is not None:
+                vector[column] = count
+        return vector
+
+    def _length_window(self, length: int) -> slice:
+        if self.threshold <= 0.0:
+            return slice(0, self._size)
+        # One character of slack each side; the exact bound is applied to the window.
+        shortest = math.floor(self.threshold * length / (2.0 - self.threshold)) - 1
+        longest = math.ceil(length * (2.0 - self.threshold) / self.threshold) + 1
+        lengths = self._lengths[:self._size]
+        return slice(
+            int(lengths.searchsorted(shortest, side="left")),
+            int(lengths.searchsorted(longest, side="right"))
+        )
+
+    def has_similar(self, phrase: str) -> bool:
+        """
+        Return True if any kept phrase is similar to `phrase` at the index threshold.
+        """
+        normalized = normalize_phrase(phrase)
+        # ratio() never exceeds 1.0.
+        if self.threshold > 1.0:
+            return False
+        # Identical strings always score 1.0 (below difflib's 200-char autojunk cutoff).
+        if normalized in self._exact and len(normalized) < 200:
+            return True
+
+        length = len(normalized)
+        window = self._length_window(length)
+        lengths = self._lengths[window]
+        totals = lengths + length
+        in_window = self._bound_reaches(np.minimum(lengths, length), totals)
+        vector = self._count_vector(Counter(normalized))
+        counts = self._counts[window][in_window, :len(vector)]
+        ids, totals = self._ids[window][in_window], totals[in_window]
+        if not len(ids):
+            return False
+
+        shared = np.minimum(counts, vector).sum(axis=1)
+        passing = self._bound_reaches(shared, totals)
+        ids, shared = ids[passing], shared[passing]
+
+        # Most shared characters first (then oldest), so true duplicates short-circuit early.
+        for kept_id in ids[np.lexsort((ids, -shared))]:
+            matcher = self._matchers[kept_id]
+            matcher.set_seq1(normalized)
+            if matcher.ratio() >= self.threshold:
+                return True
+        return False
+
+    def add(self, phrase: str) -> None:
+        """
+        Index a kept phrase.
+        """
+        normalized = normalize_phrase(phrase)
+        kept_id = len(self._matchers)
+        # is_similar compares (new phrase, kept phrase); seq2 holds the kept side so its
+        # analysis is computed once and reused for every later comparison.
+        self._matchers.append(SequenceMatcher(None, "", normalized))
+        self._exact.add(normalized)
+
+        counts = Counter(normalized)
+        for char in counts:
+            self._columns.setdefault(char, len(self._columns))
+        rows, columns = self._counts.shape
+        if self._size == rows or len(self._columns) > columns:
+            rows = rows * 2 if self._size == rows else rows
+            columns = max(len(self._columns), columns * 2) if len(self._columns) > columns else columns
+            grown = np.zeros((rows, columns), dtype=np.int32)
+            grown[:self._size, :self._counts.shape[1]] = self._counts[:self._size]
+            self._counts = grown
+            self._lengths = np.resize(self._lengths, rows)
+            self._ids = np.resize(self._ids, rows)
+
+        size = self._size
+        position = int(self._lengths[:size].searchsorted(len(normalized), side="right"))
+        # NumPy buffers overlapping slice assignments, so these shift the tail by one row.
+        self._lengths[position + 1:size + 1] = self._lengths[position:size]
+        self._ids[position + 1:size + 1] = self._ids[position:size]
+        self._counts[position + 1:size + 1] = self._counts[position:size]
+        self._lengths[position] = len(normalized)
+        self._ids[position] = kept_id
+        self._counts[position] = 0
+        self._counts[position, :len(self._columns)] = self._count_vector(counts)
+        self._size += 1
+
+
+def filter_similar_phrases_semantic(phrases: List[str], threshold: float = 0.75) -> Dict[str, object]:
+    """
+    Semantic dedup that encodes every candidate phrase in one batched call and runs the
+    greedy keep/drop pass over the pairwise cosine matrix.
+    Keeps the same phrases, in the same order, as calling is_similar pair by pair.
+
+    Returns a dict with the kept "phrases", the "forward_passes" the pairwise path would
+    have made, and the "forward_passes_saved" by batching: none when every phrase was
+    already cached and the batch ran no forward pass either.
+    """
+    if not phrases:
+        return {"phrases": [], "forward_passes": 0, "forward_passes_saved": 0}
+
+    embeddings, batch_passes = encode_phrases_counted(phrases)
+    similarity = cosine_similarity_matrix(embeddings, embeddings).tolist()
+
+    filtered_indices = []
+    pairwise_comparisons = 0
+    for idx, row in enumerate(similarity):
+        duplicate = False
+        for kept_idx in filtered_indices:
+            pairwise_comparisons += 1
+            if row[kept_idx] >= threshold:
+                duplicate = True
+                break
+        if not duplicate:
+            filtered_indices.append(idx)
+
+    # The pairwise path runs two single-item forward passes per comparison.
+    forward_passes = 2 * pairwise_comparisons
+    return {
+        "phrases": [phrases[idx] for idx in filtered_indices],
+        "forward_passes": forward_passes,
+        "forward_passes_saved": max(0, forward_passes - 1) if batch_passes else 0,
+    }
+
+
+def filter_similar_phrases(
+    phrases: List[str],
+    threshold: float = 0.75,
+    method: str = 'string',
+    limit: Optional[int] = None
+) -> List[str]:
     """
     Filter out phrases that are similar to each other.
-    Only one phrase from a similar group is kept.
+    Only one phrase from a similar group is kept. The pass is greedy in input order, so
+    with `limit` it stops once that many phrases are kept and returns the same prefix.
+    With method == 'string' comparisons go through a StringDedupIndex.
+    With method == 'semantic' all phrases are encoded in a single batch, and the forward
+    passes that saved are counted in the embedding stats.
     """
+    if method == 'semantic':
+        batched = filter_similar_phrases_semantic(phrases, threshold)
+        print(f"Batched semantic dedup saved {batched['forward_passes_saved']} forward passes")
+        record_dedup_passes_saved(batched["forward_passes_saved"])
+        return batched["phrases"]
+
     filtered = []
+    if method == 'string':
+        index = StringDedupIndex(threshold)
+        for phrase in phrases:
+            if limit is not None and len(filtered) >= limit:
+                break
+            if not index.has_similar(phrase):
+                index.add(phrase)
+                filtered.append(phrase)
+        return filtered
+
     for phrase in phrases:
+        if limit is not None and len(filtered) >= limit:
+            break
         if not any(is_similar(phrase, existing, threshold, method) for existing in filtered):
             filtered.append(phrase)
     return filtered
 
 
+def phrase_statistics(text: str) -> Dict[str, Dict[str, int]]:
+    """
+    RAKE statistics for a text: the occurrence count of every candidate phrase plus the
+    word frequency and word degree RAKE scores them with.
+    All three are additive across texts, so statistics computed per note (or per chunk)
+    can be combined and ranked exactly as if RAKE had seen the texts in one pass.
+    """
+    rake = _get_rake()
+    rake.extract_keywords_from_text(text)
+    return {
+        "phrases": dict(Counter(rake.get_ranked_phrases())),
+        "frequency": dict(rake.get_word_frequency_distribution()),
+        "degree": dict(rake.get_word_degrees()),
+    }
+
+
+def combine_phrase_statistics(
+    base: Dict[str, Dict[str, int]],
+    other: Dict[str, Dict[str, int]],
+    sign: int = 1
+) -> Dict[str, Dict[str, int]]:
+    """
+    Add (sign=1) or subtract (sign=-1) one set of phrase statistics to/from another.
+    Entries that drop to zero are removed.
+    """
+    combined = {}
+    for field in ("phrases", "frequency", "degree"):
+        values = dict(base.get(field, {}))
+        for key, count in other.get(field, {}).items():
+            value = values.get(key, 0) + sign * count
+            if value > 0:
+                values[key] = value
+            else:
+                values.pop(key, None)
+        combined[field] = values
+    return combined
+
+
+def add_phrase_statistics(total: Dict[str, Dict[str, int]], other: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+    """
+    Add `other` into `total` in place and return it; cheaper than combine_phrase_statistics
+    when folding many partial results into one accumulator.
+    """
+    for field in ("phrases", "frequency", "degree"):
+        values = total.setdefault(field, {})
+        for key, count in other.get(field, {}).items():
+            values[key] = values.get(key, 0) + count
+    return total
+
+
+# A '.', '!' or '?' that forms a token on its own and is followed by whitespace. RAKE drops
+# it as punctuation, so no phrase spans it and cutting the text there cannot change the
+# phrase list.
+_CHUNK_BOUNDARY = re.compile(r'(?<![^\w\s])[.!?](?=\s)')
+
+
+def split_text_chunks(text: str, chunk_size: int = 20000) -> Iterator[str]:
+    """
+    Lazily split text into chunks of roughly `chunk_size` characters, cut only at
+    sentence-ending punctuation so that per-chunk phrase statistics add up to exactly
+    the statistics of the whole text. A stretch without such a boundary stays in one chunk.
+    """
+    start = 0
+    while len(text) - start > chunk_size:
+        match = _CHUNK_BOUNDARY.search(text, start + chunk_size)
+        if match is None:
+            break
+        yield text[start:match.end()]
+        start = match.end()
+    yield text[start:]
+
+
+def rank_phrases(statistics: Dict[str, Dict[str, int]]) -> List[str]:
+    """
+    Rank candidate phrases from phrase statistics the way Rake.get_ranked_phrases does:
+    degree-to-frequency score, every occurrence listed, sorted by (score, phrase) descending.
+    """
+    frequency = statistics["frequency"]
+    degree = statistics["degree"]
+    rank_list = []
+    for phrase, count in statistics["phrases"].items():
+        rank = 0.0
+        for word in phrase.split(' '):
+            rank += 1.0 * degree[word] / frequency[word]
+        rank_list.extend([(rank, phrase)] * count)
+    rank_list.sort(reverse=True)
+    return [phrase for _, phrase in rank_list]
+
+
+def select_key_concepts(
+    ranked: List[str],
+    text_length: int,
+    num_concepts: Optional[int] = 10,
+    threshold: float = 0.75,
+    similarity_method: str = 'string',
+    class_size: int = 1
+) -> List[str]:
+    """
+    Turn RAKE-ranked phrases into key concepts: length filter, similarity dedup at the
+    dynamic threshold for this text length and class size, then the top `num_concepts`
+    (all of them when num_concepts is None).
+    """
+    effective_threshold = calculate_effective_threshold(text_length, threshold, class_size)
+    print(f"RAKE found {len(ranked)} initial phrases")
+
+    # Optionally filter out phrases by length (e.g., too short or too long phrases)
+    filtered_by_length = [phrase for phrase in ranked if 3 <= len(phrase) <= 100]
+    print(f"After length filtering: {len(filtered_by_length)} phrases")
+
+    # Filter out similar phrases using the effective threshold and chosen method.
+    unique = filter_similar_phrases(filtered_by_length, effective_threshold, similarity_method, limit=num_concepts)
+    print(f"After similarity filtering: {len(unique)} unique concepts")
+
+    # Return the top concepts based on the requested number.
+    result = unique[:num_concepts]
+    print(f"Final concepts extracted: {result}")
+    return result
+
+
 def extract_key_concepts(
     text: str,
-    num_concepts: int = 10,
+    num_concepts: Optional[int] = 10,
     threshold: float = 0.75,
     similarity_method: str = 'string',
     class_size: int = 1
@@ -76,7 +459,7 @@ def extract_key_concepts(
     
     Args:
         text: The text to extract concepts from.
-        num_concepts: Maximum number of concepts to extract (default 10).
+        num_concepts: Maximum number of concepts to extract (default 10, None for all).
         threshold: Similarity threshold for filtering similar concepts (default 0.75).
         similarity_method: 'string' or 'semantic' for phrase comparison.
         class_size: Class size used to adjust the dynamic threshold.
@@ -92,30 +475,43 @@ def extract_key_concepts(
         print("Text too short for meaningful extraction")
         return []
     
-    # Calculate a dynamic threshold based on text length and class size.
-    dynamic_threshold = calculate_dynamic_threshold(len(text), class_size)
-    effective_threshold = min(threshold, dynamic_threshold)
-    print(f"Calculated dynamic threshold: {dynamic_threshold}, effective_threshold: {effective_threshold}")
-    
     try:
-        # Initialize RAKE with English stopwords from NLTK.
-        rake = Rake(stopwords=stopwords.words('english'))
+        rake = _get_rake()
         rake.extract_keywords_from_text(text)
         ranked = rake.get_ranked_phrases()
-        print(f"RAKE found {len(ranked)} initial phrases")
-        
-        # Optionally filter out phrases by length (e.g., too short or too long phrases)
-        filtered_by_length = [phrase for phrase in ranked if 3 <= len(phrase) <= 100]
-        print(f"After length filtering: {len(filtered_by_length)} phrases")
-        
-        # Filter out similar phrases using the effective threshold and chosen method.
-        unique = filter_similar_phrases(filtered_by_length, effective_threshold, similarity_method)
-        print(f"After similarity filtering: {len(unique)} unique concepts")
-        
-        # Return the top concepts based on the requested number.
-        result = unique[:num_concepts]
-        print(f"Final concepts extracted: {result}")
-        return result
+        return select_key_concepts(ranked, len(text), num_concepts, threshold, similarity_method, class_size)
+    except NLTKResourceMissing:
+        # A deployment problem, not a property of this text: let the caller answer 503.
+        raise
+    except Exception as e:
+        print(f"Error extracting key concepts: {e}")
+        return []
+
+
+def extract_key_concepts_from_statistics(
+    statistics: Dict[str, Dict[str, int]],
+    text_length: int,
+    num_concepts: int = 10,
+    threshold: float = 0.75,
+    similarity_method: str = 'string',
+    class_size: int = 1
+) -> List[str]:
+    """
+    Same as extract_key_concepts, but starting from precomputed phrase statistics
+    (see phrase_statistics) for a text of `text_length` characters.
+    """
+    print(f"Extracting key concepts from statistics for text of length {text_length}")
+    print(f"Parameters: num_concepts={num_concepts}, threshold={threshold}, method={similarity_method}, class_size={class_size}")
+
+    if text_length < 50:
+        print("Text too short for meaningful extraction")
+        return []
+
+    try:
+        ranked = rank_phrases(statistics)
+        return select_key_concepts(ranked, text_length, num_concepts, threshold, similarity_method, class_size)
+    except NLTKResourceMissing:
+        raise
     except Exception as e:
         print(f"Error extracting key concepts: {e}")
         return []
@@ -0,0 +1,109 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+from app.metrics import percentiles
+
+# Threads for password hashing; bcrypt releases the GIL, so these run in parallel.
+PASSWORD_HASH_WORKERS = max(1, int(os.getenv("PASSWORD_HASH_WORKERS", "2")))
+# Maximum number of hashes submitted at once (running + queued) before logins get a 503.
+PASSWORD_HASH_QUEUE_SIZE = max(1, int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", "64")))
+# Latency samples kept for the percentiles.
+PASSWORD_HASH_METRICS_WINDOW = int(os.getenv("PASSWORD_HASH_METRICS_WINDOW", "1000"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_in_flight = 0
+_running = 0
+_lock = threading.Lock()
+_stats = {"completed": 0, "rejected": 0, "peak_queue_depth": 0}
+_hash_ms: deque = deque(maxlen=PASSWORD_HASH_METRICS_WINDOW)
+_wait_ms: deque = deque(maxlen=PASSWORD_HASH_METRICS_WINDOW)
+
+
+def get_hash_executor() -> ThreadPoolExecutor:
+    """
+    Return the password hashing thread pool, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+    return _executor
+
+
+def shutdown_hash_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _timed(fn: Callable[..., Any], submitted_at: float, *args, **kwargs) -> Any:
+    global _running
+    started = time.perf_counter()
+    with _lock:
+        _running += 1
+        _wait_ms.append((started - submitted_at) * 1000)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        with _lock:
+            _running -= 1
+            _hash_ms.append((time.perf_counter() - started) * 1000)
+            _stats["completed"] += 1
+
+
+def _release_slot(_future) -> None:
+    global _in_flight
+    _in_flight -= 1
+
+
+async def run_hash(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run a password hashing function in the hashing thread pool without blocking the
+    event loop. Raises HTTP 503 when PASSWORD_HASH_QUEUE_SIZE hashes are already submitted.
+    """
+    global _in_flight
+    if _in_flight >= PASSWORD_HASH_QUEUE_SIZE:
+        _stats["rejected"] += 1
+        raise HTTPException(
+            status_code=503,
+            detail="Too many logins in progress, please retry shortly.",
+            headers={"Retry-After": "2"}
+        )
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        get_hash_executor(), functools.partial(_timed, fn, time.perf_counter(), *args, **kwargs)
+    )
+    _in_flight += 1
+    _stats["peak_queue_depth"] = max(_stats["peak_queue_depth"], _in_flight - _running)
+    future.add_done_callback(_release_slot)
+    # A cancelled request leaves the hash running; its slot is freed when the hash finishes.
+    return await asyncio.shield(future)
+
+
+def password_hash_stats() -> Dict[str, Any]:
+    """
+    Pool size, current queue depth and hash/wait latency percentiles for this process.
+    """
+    with _lock:
+        hash_ms = list(_hash_ms)
+        wait_ms = list(_wait_ms)
+        running = _running
+    return {
+        "workers": PASSWORD_HASH_WORKERS,
+        "queue_size": PASSWORD_HASH_QUEUE_SIZE,
+        "in_flight": _in_flight,
+        "running": running,
+        "queue_depth": max(0, _in_flight - running),
+        **_stats,
+        "hash_latency_ms": percentiles(hash_ms),
+        "queue_wait_ms": percentiles(wait_ms),
+    }
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pymongo import ReturnDocument
+
+from app.analysis import run_detailed_analysis
+from app.concept_index import get_class_version
+from app.db import get_database_client
+
+# Detailed-analysis jobs, one document per (user_id, class_id, class_version).
+ANALYSIS_JOBS_COLLECTION = "analysis_jobs"
+# Jobs processed at once by this process.
+ANALYSIS_JOB_WORKERS = max(1, int(os.getenv("ANALYSIS_JOB_WORKERS", "2")))
+# A job still queued or running after this many seconds is assumed lost (e.g. the process restarted).
+ANALYSIS_JOB_STALE_AFTER = float(os.getenv("ANALYSIS_JOB_STALE_AFTER", "600"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+
+
+def _is_stale(job: Dict[str, Any]) -> bool:
+    if job.get("status") not in (JOB_QUEUED, JOB_RUNNING):
+        return False
+    updated_at = job.get("updated_at") or job.get("created_at")
+    return updated_at is None or datetime.utcnow() - updated_at > timedelta(seconds=ANALYSIS_JOB_STALE_AFTER)
+
+
+def job_response(job: Dict[str, Any]) -> Dict[str, Any]:
+    response = {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "user_id": job["user_id"],
+        "class_id": job["class_id"],
+        "class_version": job["class_version"],
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+    }
+    if "result" in job:
+        response["result"] = job["result"]
+    if job["status"] == JOB_FAILED:
+        response["error"] = job.get("error")
+    return response
+
+
+async def _process(job_id: str) -> None:
+    async with get_database_client() as client:
+        db = client.notes_db
+        job = await db[ANALYSIS_JOBS_COLLECTION].find_one_and_update(
+            {"_id": job_id, "status": JOB_QUEUED},
+            {"$set": {"status": JOB_RUNNING, "updated_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            # Already claimed by another worker or process.
+            return
+        print(f"Running analysis job {job_id} for user {job['user_id']} in class {job['class_id']}")
+        try:
+            result = await run_detailed_analysis(db, job["user_id"], job["class_id"], endpoint="analysis-jobs")
+            # Fallback and error results are kept for the poller but retried on the next submit.
+            if result.get("status") == "success":
+                update = {"status": JOB_DONE, "result": result}
+            else:
+                update = {"status": JOB_FAILED, "result": result, "error": result.get("error") or result.get("message")}
+        except Exception as e:
+            print(f"Analysis job {job_id} failed: {e}")
+            update = {"status": JOB_FAILED, "error": getattr(e, "detail", None) or str(e)}
+        update["updated_at"] = datetime.utcnow()
+        await db[ANALYSIS_JOBS_COLLECTION].update_one({"_id": job_id}, {"$set": update})
+
+
+async def _worker() -> None:
+    while True:
+        job_id = await _queue.get()
+        try:
+            await _process(job_id)
+        except Exception as e:
+            print(f"Analysis job worker error for job {job_id}: {e}")
+        finally:
+            _queue.task_done()
+
+
+def _enqueue(job_id: str) -> None:
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue()
+    if not _workers:
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(ANALYSIS_JOB_WORKERS))
+    _queue.put_nowait(job_id)
+
+
+async def submit_analysis_job(db, user_id: str, class_id: str) -> Dict[str, Any]:
+    """
+    Return the analysis job for the class's current content version, creating and
+    queueing it if none exists. Finished jobs are returned with their stored result;
+    failed or stale ones are queued again.
+    """
+    class_version = await get_class_version(db, class_id)
+    key = {"user_id": user_id, "class_id": class_id, "class_version": class_version}
+    now = datetime.utcnow()
+    new_id = uuid.uuid4().hex
+    job = await db[ANALYSIS_JOBS_COLLECTION].find_one_and_update(
+        key,
+        {"$setOnInsert": {"_id": new_id, "status": JOB_QUEUED, "created_at": now, "updated_at": now}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if job["status"] == JOB_FAILED or _is_stale(job):
+        job = await db[ANALYSIS_JOBS_COLLECTION].find_one_and_update(
+            {"_id": job["_id"]},
+            {"$set": {"status": JOB_QUEUED, "updated_at": now}, "$unset": {"error": "", "result": ""}},
+            return_document=ReturnDocument.AFTER
+        )
+        _enqueue(job["_id"])
+    elif job["_id"] == new_id:
+        _enqueue(job["_id"])
+    return job
+
+
+async def get_analysis_job(db, job_id: str) -> Optional[Dict[str, Any]]:
+    return await db[ANALYSIS_JOBS_COLLECTION].find_one({"_id": job_id})
+
+
+async def resume_analysis_jobs() -> None:
+    """
+    Queue jobs left waiting by a previous run of the server.
+    """
+    async with get_database_client() as client:
+        db = client.notes_db
+        pending = await db[ANALYSIS_JOBS_COLLECTION].find({"status": JOB_QUEUED}, {"_id": 1}).to_list(length=None)
+    for job in pending:
+        _enqueue(job["_id"])
+    if pending:
+        print(f"Resumed {len(pending)} queued analysis jobs")
+
+
+async def shutdown_analysis_workers() -> None:
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
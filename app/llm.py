@@ -0,0 +1,380 @@
+import asyncio
+import hashlib
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from app.cache import TTLCache
+from app.llm_metrics import call_cost, record_llm_call
+from app.llm_providers import LLMProvider, LLMUnavailable, get_llm_provider
+
+# LLM responses kept per prompt; identical class state produces identical prompts.
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+# Upstream calls allowed at once across the whole process.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+# Seconds allowed per upstream attempt.
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+# Extra attempts after a transient failure, with exponential backoff plus jitter.
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+# Consecutive failed calls that open the circuit, and how long it stays open.
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+_responses = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+# Upstream calls currently running, by prompt key; identical requests await the same task.
+_in_flight: Dict[str, asyncio.Task] = {}
+# Chunks of the in-flight calls that are streams, by prompt key.
+_streams: Dict[str, "StreamFanout"] = {}
+_stats = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0, "retries": 0, "short_circuited": 0}
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def llm_configured() -> bool:
+    """
+    Whether the selected LLM provider can be called (for Gemini, whether a key is set).
+    """
+    return get_llm_provider().configured()
+
+
+def _transient_errors(provider: LLMProvider):
+    """
+    Errors worth retrying: deadlines plus the provider's rate-limit and overload errors.
+    """
+    return (asyncio.TimeoutError, *provider.transient_errors)
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _semaphore
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects calls for `cooldown` seconds,
+    then lets a single trial call through; its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int = LLM_BREAKER_THRESHOLD, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def release_trial(self) -> None:
+        self._trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_running = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+
+
+def prompt_key(prompt: str, model_name: str) -> str:
+    return hashlib.sha256(f"{model_name}\x00{prompt}".encode("utf-8")).hexdigest()
+
+
+async def _call_provider(prompt: str, model_name: str) -> Dict[str, Any]:
+    """
+    One upstream call with retries, bounded by the process-wide semaphore and a deadline
+    per attempt. Raises LLMUnavailable when the circuit is open or transient errors persist.
+    """
+    provider = get_llm_provider()
+    provider.ensure_configured()
+    if not breaker.allow():
+        _stats["short_circuited"] += 1
+        raise LLMUnavailable("LLM circuit breaker is open")
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            async with _get_semaphore():
+                completion = await asyncio.wait_for(provider.generate(prompt, model_name), LLM_TIMEOUT)
+            breaker.record_success()
+            return completion
+        except _transient_errors(provider) as e:
+            if attempt == LLM_MAX_RETRIES:
+                breaker.record_failure()
+                raise LLMUnavailable(f"LLM unavailable after {attempt + 1} attempts: {e!r}") from e
+            _stats["retries"] += 1
+            await asyncio.sleep(LLM_BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.5))
+        except asyncio.CancelledError:
+            breaker.release_trial()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+
+
+class StreamFanout:
+    """
+    Chunks of one upstream stream, replayed to every reader of the same prompt: a reader
+    joining late first gets the chunks already produced, then follows the live stream.
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def push(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._notify()
+
+    def close(self) -> None:
+        self.done = True
+        self._notify()
+
+    async def read(self) -> AsyncIterator[str]:
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+async def _stream_provider(prompt: str, model_name: str, fanout: StreamFanout) -> Dict[str, Any]:
+    """
+    One upstream stream, pushing chunks to `fanout` and returning the completion.
+    Streams are not retried once they have started.
+    """
+    provider = get_llm_provider()
+    completion: Dict[str, Any] = {}
+    try:
+        async with _get_semaphore():
+            chunks = provider.stream(prompt, model_name, completion).__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), LLM_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                fanout.push(chunk)
+    except _transient_errors(provider) as e:
+        breaker.record_failure()
+        raise LLMUnavailable(f"LLM stream failed: {e!r}") from e
+    except asyncio.CancelledError:
+        breaker.release_trial()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    finally:
+        fanout.close()
+    breaker.record_success()
+    return completion
+
+
+def _finish(key: str, task: asyncio.Task) -> None:
+    _in_flight.pop(key, None)
+    _streams.pop(key, None)
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        _stats["errors"] += 1
+    else:
+        _responses.set(key, task.result())
+
+
+async def generate(prompt: str, model_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Return the LLM's response for `prompt` as {"text", "prompt_tokens", "response_tokens",
+    "source"}, served from the response cache when possible ("source": "cache").
+    Concurrent calls with the same prompt share one upstream request ("coalesced"); if it
+    fails, every waiter gets the error and nothing is cached. Raises LLMUnavailable when
+    the provider is not configured, short-circuited or keeps failing transiently.
+    `model_name` defaults to the provider's model.
+    """
+    model_name = model_name or get_llm_provider().model_name
+    key = prompt_key(prompt, model_name)
+    cached = _responses.get(key)
+    if cached is not None:
+        _stats["hits"] += 1
+        return {**cached, "source": "cache"}
+
+    task = _in_flight.get(key)
+    if task is None:
+        _stats["misses"] += 1
+        source = "upstream"
+        task = asyncio.ensure_future(_call_provider(prompt, model_name))
+        task.add_done_callback(lambda t: _finish(key, t))
+        _in_flight[key] = task
+    else:
+        _stats["coalesced"] += 1
+        source = "coalesced"
+    # Shielded so one caller disconnecting does not cancel the call for the others.
+    return {**await asyncio.shield(task), "source": source}
+
+
+async def generate_text(prompt: str, model_name: Optional[str] = None) -> str:
+    """
+    Text of generate(prompt).
+    """
+    return (await generate(prompt, model_name))["text"]
+
+
+async def stream_text(
+    prompt: str,
+    model_name: Optional[str] = None,
+    usage: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[str]:
+    """
+    Yield the LLM's response for `prompt` incrementally as it is generated. Cached prompts
+    yield the complete text once. Concurrent streams of the same prompt share one upstream
+    stream ("coalesced"), and generate() calls for it wait on the same request; a prompt
+    already in flight through generate() yields the complete text once. The upstream stream
+    runs to completion even if its readers disconnect, and the full text is cached.
+    Token counts and source are written to `usage` once the stream completes.
+    """
+    usage = usage if usage is not None else {}
+    provider = get_llm_provider()
+    model_name = model_name or provider.model_name
+    key = prompt_key(prompt, model_name)
+    cached = _responses.get(key)
+    if cached is not None:
+        _stats["hits"] += 1
+        usage.update(cached, source="cache")
+        yield cached["text"]
+        return
+
+    task = _in_flight.get(key)
+    if task is None:
+        provider.ensure_configured()
+        if not breaker.allow():
+            _stats["short_circuited"] += 1
+            raise LLMUnavailable("LLM circuit breaker is open")
+        _stats["misses"] += 1
+        source = "upstream"
+        fanout = StreamFanout()
+        task = asyncio.ensure_future(_stream_provider(prompt, model_name, fanout))
+        task.add_done_callback(lambda t: _finish(key, t))
+        _in_flight[key] = task
+        _streams[key] = fanout
+    else:
+        _stats["coalesced"] += 1
+        source = "coalesced"
+        fanout = _streams.get(key)
+
+    if fanout is None:
+        completion = await asyncio.shield(task)
+        usage.update(completion, source=source)
+        yield completion["text"]
+        return
+    async for chunk in fanout.read():
+        yield chunk
+    # Raises the upstream error, if any, once the chunks produced before it are delivered.
+    completion = await asyncio.shield(task)
+    usage.update(completion, source=source)
+
+
+class LLMCall:
+    """
+    Instrumentation for one LLM request made on behalf of an endpoint. Used as an async
+    context manager around the call and the parsing of its result; on exit the call's
+    tokens, latency, cost and outcome ("success", "json_parse_failure", "unavailable" or
+    "error") are added to the LLM metrics. Callers set `outcome` when parsing fails.
+    """
+
+    def __init__(self, endpoint: str, model_name: Optional[str] = None):
+        self.endpoint = endpoint
+        self.model_name = model_name or get_llm_provider().model_name
+        self.outcome = "success"
+        self.source = "none"
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.latency_ms = 0.0
+        self._started = None
+
+    async def __aenter__(self) -> "LLMCall":
+        self._started = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        self.latency_ms = (time.perf_counter() - self._started) * 1000
+        if exc_type is not None:
+            self.outcome = "unavailable" if issubclass(exc_type, LLMUnavailable) else "error"
+        record_llm_call(self.summary())
+        return False
+
+    def _record_usage(self, completion: Dict[str, Any]) -> None:
+        self.source = completion.get("source", self.source)
+        self.prompt_tokens = completion.get("prompt_tokens", 0)
+        self.response_tokens = completion.get("response_tokens", 0)
+
+    async def generate(self, prompt: str) -> str:
+        completion = await generate(prompt, self.model_name)
+        self._record_usage(completion)
+        return completion["text"]
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        usage: Dict[str, Any] = {}
+        async for chunk in stream_text(prompt, self.model_name, usage):
+            yield chunk
+        self._record_usage(usage)
+
+    def cost_usd(self) -> float:
+        # Cache hits and coalesced calls made no request of their own.
+        if self.source != "upstream":
+            return 0.0
+        prices = get_llm_provider().prices_per_1k_tokens
+        return round(call_cost(self.prompt_tokens, self.response_tokens, prices), 6)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "endpoint": self.endpoint,
+            "model": self.model_name,
+            "outcome": self.outcome,
+            "source": self.source,
+            "prompt_tokens": self.prompt_tokens,
+            "response_tokens": self.response_tokens,
+            "cost_usd": self.cost_usd(),
+            "latency_ms": round(self.latency_ms, 2),
+        }
+
+
+def llm_cache_stats() -> Dict[str, object]:
+    stats = dict(_stats)
+    stats["entries"] = len(_responses)
+    stats["in_flight"] = len(_in_flight)
+    stats["provider"] = get_llm_provider().name
+    stats["capacity"] = LLM_CACHE_SIZE
+    stats["ttl"] = LLM_CACHE_TTL
+    stats["breaker_state"] = breaker.state
+    stats["consecutive_failures"] = breaker.failures
+    return stats
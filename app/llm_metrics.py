@@ -0,0 +1,78 @@
+import os
+import threading
+from collections import Counter, deque
+from typing import Any, Dict
+
+from app.llm_providers import get_llm_provider
+from app.metrics import percentiles
+
+# Latency samples kept per endpoint for the percentiles.
+LLM_METRICS_WINDOW = int(os.getenv("LLM_METRICS_WINDOW", "1000"))
+
+_lock = threading.Lock()
+_endpoints: Dict[str, Dict[str, Any]] = {}
+
+
+def call_cost(prompt_tokens: int, response_tokens: int, prices: Dict[str, float]) -> float:
+    """
+    USD cost of one call at `prices` (a provider's prices_per_1k_tokens).
+    """
+    return prompt_tokens / 1000 * prices["prompt"] + response_tokens / 1000 * prices["response"]
+
+
+def record_llm_call(call: Dict[str, Any]) -> None:
+    """
+    Add one finished LLM call (a LLMCall summary) to the per-endpoint aggregates.
+    Cache hits and coalesced calls are counted but cost nothing.
+    """
+    with _lock:
+        entry = _endpoints.get(call["endpoint"])
+        if entry is None:
+            entry = _endpoints[call["endpoint"]] = {
+                "calls": 0,
+                "outcomes": Counter(),
+                "sources": Counter(),
+                "models": Counter(),
+                "prompt_tokens": 0,
+                "response_tokens": 0,
+                "cost_usd": 0.0,
+                "latencies_ms": deque(maxlen=LLM_METRICS_WINDOW),
+                "upstream_latencies_ms": deque(maxlen=LLM_METRICS_WINDOW),
+            }
+        entry["calls"] += 1
+        entry["outcomes"][call["outcome"]] += 1
+        entry["sources"][call["source"]] += 1
+        entry["models"][call["model"]] += 1
+        entry["latencies_ms"].append(call["latency_ms"])
+        if call["source"] == "upstream":
+            entry["prompt_tokens"] += call["prompt_tokens"]
+            entry["response_tokens"] += call["response_tokens"]
+            entry["cost_usd"] += call["cost_usd"]
+            entry["upstream_latencies_ms"].append(call["latency_ms"])
+
+
+def llm_metrics() -> Dict[str, Any]:
+    """
+    Per-endpoint LLM call counts, outcomes, tokens, estimated cost and latency percentiles
+    for this process.
+    """
+    with _lock:
+        endpoints = {
+            endpoint: {
+                "calls": entry["calls"],
+                "outcomes": dict(entry["outcomes"]),
+                "sources": dict(entry["sources"]),
+                "models": dict(entry["models"]),
+                "prompt_tokens": entry["prompt_tokens"],
+                "response_tokens": entry["response_tokens"],
+                "cost_usd": round(entry["cost_usd"], 6),
+                "latency_ms": percentiles(entry["latencies_ms"]),
+                "upstream_latency_ms": percentiles(entry["upstream_latencies_ms"]),
+            }
+            for endpoint, entry in _endpoints.items()
+        }
+    return {
+        "endpoints": endpoints,
+        "total_cost_usd": round(sum(entry["cost_usd"] for entry in endpoints.values()), 6),
+        "prices_per_1k_tokens": get_llm_provider().prices_per_1k_tokens,
+    }
@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, List, Tuple, Type
+
+from app.condense import estimate_tokens
+
+# "gemini" (default) or "local" for the deterministic offline backend used in load tests.
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
+# Gemini USD per 1000 tokens, defaulting to gemini-1.5-flash list prices.
+LLM_PRICE_PROMPT_PER_1K = float(os.getenv("LLM_PRICE_PROMPT_PER_1K", "0.000075"))
+LLM_PRICE_RESPONSE_PER_1K = float(os.getenv("LLM_PRICE_RESPONSE_PER_1K", "0.0003"))
+# Synthetic latency of the local backend in seconds: LOCAL_LLM_LATENCY ± LOCAL_LLM_JITTER,
+# fixed per prompt so repeated runs are comparable.
+LOCAL_LLM_LATENCY = float(os.getenv("LOCAL_LLM_LATENCY", "1.0"))
+LOCAL_LLM_JITTER = float(os.getenv("LOCAL_LLM_JITTER", "0.25"))
+# Number of chunks the local backend splits a streamed response into.
+LOCAL_LLM_STREAM_CHUNKS = int(os.getenv("LOCAL_LLM_STREAM_CHUNKS", "8"))
+
+
+class LLMUnavailable(Exception):
+    """
+    The LLM is failing, slow or short-circuited; callers should serve their non-LLM result.
+    """
+
+
+def completion(prompt: str, text: str, response=None) -> Dict[str, Any]:
+    """
+    Response text with token counts, taken from the response's usage metadata when present
+    and estimated from the text otherwise.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "text": text,
+        "prompt_tokens": getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt),
+        "response_tokens": getattr(usage, "candidates_token_count", None) or estimate_tokens(text),
+    }
+
+
+class LLMProvider(ABC):
+    """
+    Backend interface used by app.llm. Caching, coalescing, concurrency limits, deadlines,
+    retries and the circuit breaker live in app.llm; providers only talk to the model.
+    """
+
+    name = "base"
+    model_name = ""
+    # Exception types worth retrying, in addition to timeouts.
+    transient_errors: Tuple[Type[BaseException], ...] = ()
+    # USD per 1000 prompt and response tokens, used for the cost in the LLM metrics.
+    prices_per_1k_tokens: Dict[str, float] = {"prompt": 0.0, "response": 0.0}
+
+    @abstractmethod
+    def configured(self) -> bool:
+        """
+        Whether the provider can be called.
+        """
+
+    def ensure_configured(self) -> None:
+        """
+        Prepare the client; raises LLMUnavailable when the provider cannot be used.
+        """
+
+    @abstractmethod
+    async def generate(self, prompt: str, model_name: str) -> Dict[str, Any]:
+        """
+        Return completion(prompt, text, response) for one request.
+        """
+
+    @abstractmethod
+    def stream(self, prompt: str, model_name: str, usage: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        Yield the response text in chunks, then fill `usage` with completion(...).
+        """
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+    model_name = GEMINI_MODEL_NAME
+    prices_per_1k_tokens = {"prompt": LLM_PRICE_PROMPT_PER_1K, "response": LLM_PRICE_RESPONSE_PER_1K}
+
+    def __init__(self):
+        self._configured_key = None
+        from google.api_core import exceptions as google_exceptions
+
+        # Rate limits, overload and upstream timeouts.
+        self.transient_errors = (
+            google_exceptions.ResourceExhausted,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+            google_exceptions.GatewayTimeout,
+        )
+
+    def configured(self) -> bool:
+        return bool(os.environ.get("GEMINI_API_KEY"))
+
+    def ensure_configured(self) -> None:
+        """
+        Configure the Gemini SDK once, and again only if the key in the environment changes.
+        """
+        import google.generativeai as genai
+
+        api_key = os.environ.get("GEMINI_API_KEY")
+        if not api_key:
+            raise LLMUnavailable("Gemini API key not configured")
+        if api_key != self._configured_key:
+            genai.configure(api_key=api_key)
+            self._configured_key = api_key
+
+    async def generate(self, prompt: str, model_name: str) -> Dict[str, Any]:
+        import google.generativeai as genai
+
+        response = await genai.GenerativeModel(model_name).generate_content_async(prompt)
+        return completion(prompt, response.text, response)
+
+    async def stream(self, prompt: str, model_name: str, usage: Dict[str, Any]) -> AsyncIterator[str]:
+        import google.generativeai as genai
+
+        response = await genai.GenerativeModel(model_name).generate_content_async(prompt, stream=True)
+        parts = []
+        async for chunk in response:
+            parts.append(chunk.text)
+            yield chunk.text
+        usage.update(completion(prompt, "".join(parts), response))
+
+
+def _prompt_list(prompt: str, label: str) -> List[str]:
+    """
+    Comma-separated list following `label` in a prompt, on the same line or the next one.
+    """
+    start = prompt.find(label)
+    if start < 0:
+        return []
+    lines = prompt[start + len(label):].splitlines()
+    value = lines[0].strip() if lines else ""
+    if not value and len(lines) > 1:
+        value = lines[1].strip()
+    if not value or value == "None":
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class LocalProvider(LLMProvider):
+    """
+    Deterministic offline backend: answers with schema-valid JSON built from the concept
+    lists in the prompt, after a synthetic delay. Lets extraction, database, parsing and
+    caching be load-tested without quota use or network jitter. Its calls cost nothing.
+    """
+
+    name = "local"
+    model_name = "local-synthetic"
+
+    def configured(self) -> bool:
+        return True
+
+    def _latency(self, prompt: str) -> float:
+        seed = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        return max(0.0, LOCAL_LLM_LATENCY + random.Random(seed).uniform(-LOCAL_LLM_JITTER, LOCAL_LLM_JITTER))
+
+    def respond(self, prompt: str) -> str:
+        if '"conceptHierarchy"' in prompt:
+            student = _prompt_list(prompt, "Student's concepts:")
+            common = _prompt_list(prompt, "Common concepts:")
+            missing = _prompt_list(prompt, "Missing concepts:")
+            return json.dumps({
+                "conceptHierarchy": {"Shared": common, "Your notes": student, "Class notes": missing},
+                "learningGaps": missing[:5],
+                "studyRecommendations": [f"Review {concept}" for concept in missing[:2]],
+            })
+
+        student = _prompt_list(prompt, "EXTRACTED KEY CONCEPTS FROM STUDENT'S NOTES:")
+        dataset = _prompt_list(prompt, "EXTRACTED KEY CONCEPTS FROM DATASET:")
+        missing = [concept for concept in dataset if concept not in student]
+        return json.dumps({
+            "topicCoverage": student,
+            "missingTopics": missing,
+            "datasetKnowledge": dataset[:5],
+            "qualityAssessment": f"Covers {len(student)} key concepts; {len(missing)} class concepts are missing.",
+            "strengthsAndWeaknesses": {
+                "strengths": [f"Covers {concept}" for concept in student[:3]],
+                "weaknesses": [f"Does not cover {concept}" for concept in missing[:3]],
+            },
+            "studyRecommendations": [f"Add notes on {concept}" for concept in missing[:3]],
+        })
+
+    async def generate(self, prompt: str, model_name: str) -> Dict[str, Any]:
+        await asyncio.sleep(self._latency(prompt))
+        return completion(prompt, self.respond(prompt))
+
+    async def stream(self, prompt: str, model_name: str, usage: Dict[str, Any]) -> AsyncIterator[str]:
+        text = self.respond(prompt)
+        count = max(1, LOCAL_LLM_STREAM_CHUNKS)
+        size = -(-len(text) // count)
+        delay = self._latency(prompt) / count
+        for start in range(0, len(text), size):
+            await asyncio.sleep(delay)
+            yield text[start:start + size]
+        usage.update(completion(prompt, text))
+
+
+_PROVIDERS = {"gemini": GeminiProvider, "local": LocalProvider}
+_provider = None
+
+
+def get_llm_provider() -> LLMProvider:
+    """
+    Return the provider selected by LLM_PROVIDER, created on first use.
+    """
+    global _provider
+    if _provider is None:
+        if LLM_PROVIDER not in _PROVIDERS:
+            raise ValueError(f"Unknown LLM_PROVIDER {LLM_PROVIDER!r}; expected one of {sorted(_PROVIDERS)}")
+        _provider = _PROVIDERS[LLM_PROVIDER]()
+    return _provider
@@ -0,0 +1,15 @@
+from typing import Dict, Iterable
+
+
+def percentiles(samples: Iterable[float]) -> Dict[str, float]:
+    """
+    p50/p95/p99/max of latency samples in milliseconds, rounded to 0.01; {} when empty.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 2)
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": round(ordered[-1], 2)}
@@ -0,0 +1,113 @@
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from pymongo.errors import OperationFailure
+
+# Characters of each note's content returned by the analysis queries, cut server-side
+# (0 = whole note). Capping changes the text concepts are computed from, so stored
+# student concepts are recomputed for capped notes.
+NOTE_CONTENT_LIMIT = int(os.getenv("NOTE_CONTENT_LIMIT", "0"))
+# Notes per batch when classmates' content is streamed instead of returned in one document.
+NOTE_STREAM_BATCH_SIZE = int(os.getenv("NOTE_STREAM_BATCH_SIZE", "100"))
+
+# student_concepts fields read by the analyses; concept embeddings are left on the server.
+STORED_CONCEPT_FIELDS = ["concepts", "all_concepts", "content_version", "similarity_method", "effective_threshold"]
+
+# Aggregation results are single BSON documents capped at 16MB.
+_BSON_TOO_LARGE = 10334
+
+
+def _content_projection(content_limit: int) -> Dict[str, Any]:
+    if content_limit > 0:
+        return {"_id": 0, "content": {"$substrCP": ["$content", 0, content_limit]}}
+    return {"_id": 0, "content": 1}
+
+
+def _analysis_pipeline(user_id: str, class_id: str, include_others: bool, content_limit: int) -> List[Dict[str, Any]]:
+    content = _content_projection(content_limit)
+    others = {"user_id": {"$ne": user_id}}
+    facets: Dict[str, List[Dict[str, Any]]] = {
+        "student": [{"$match": {"user_id": user_id}}, {"$project": content}],
+        "other_count": [{"$match": others}, {"$count": "count"}],
+        # Attached to one class note so it costs a single indexed lookup.
+        "stored": [
+            {"$limit": 1},
+            {"$lookup": {
+                "from": "student_concepts",
+                "pipeline": [
+                    {"$match": {"class_id": class_id, "user_id": user_id}},
+                    {"$project": {"_id": 0, **{field: 1 for field in STORED_CONCEPT_FIELDS}}},
+                ],
+                "as": "doc",
+            }},
+            {"$project": {"_id": 0, "doc": 1}},
+        ],
+    }
+    if include_others:
+        facets["others"] = [{"$match": {**others, "content": {"$exists": True}}}, {"$project": content}]
+    return [{"$match": {"class_id": class_id}}, {"$facet": facets}]
+
+
+async def stream_note_contents(
+    db,
+    class_id: str,
+    exclude_user_id: Optional[str] = None,
+    content_limit: int = NOTE_CONTENT_LIMIT,
+    batch_size: int = NOTE_STREAM_BATCH_SIZE
+) -> AsyncIterator[str]:
+    """
+    Yield the content of each note in the class, except `exclude_user_id`'s, fetched in
+    batches with only the content field projected.
+    """
+    query: Dict[str, Any] = {"class_id": class_id, "content": {"$exists": True}}
+    if exclude_user_id is not None:
+        query["user_id"] = {"$ne": exclude_user_id}
+    projection = {"_id": 0, "content": 1}
+    cursor = db.notes.find(query, projection, batch_size=batch_size)
+    async for doc in cursor:
+        text = doc["content"]
+        yield text[:content_limit] if content_limit > 0 else text
+
+
+async def load_analysis_inputs(
+    db,
+    user_id: str,
+    class_id: str,
+    include_others: bool = False,
+    content_limit: int = NOTE_CONTENT_LIMIT
+) -> Dict[str, Any]:
+    """
+    Fetch what the analysis endpoints need in one $facet aggregation over the class notes:
+    the student's note contents, the number of classmates' notes (and their contents with
+    `include_others`), and the stored student concepts without their embeddings.
+
+    Returns {"student_contents", "other_contents", "other_note_count", "stored_concepts"}.
+    "other_contents" is empty unless requested. If the classmates' text does not fit in a
+    single aggregation result, it is streamed from a cursor instead.
+    """
+    pipeline = _analysis_pipeline(user_id, class_id, include_others, content_limit)
+    try:
+        results = await db.notes.aggregate(pipeline).to_list(length=1)
+        streamed = False
+    except OperationFailure as e:
+        if not include_others or e.code != _BSON_TOO_LARGE:
+            raise
+        print(f"Class {class_id} notes exceed one aggregation result, streaming classmates' notes")
+        pipeline = _analysis_pipeline(user_id, class_id, False, content_limit)
+        results = await db.notes.aggregate(pipeline).to_list(length=1)
+        streamed = True
+
+    facets = results[0] if results else {}
+    stored = (facets.get("stored") or [{}])[0].get("doc") or [None]
+    other_count = (facets.get("other_count") or [{}])[0].get("count", 0)
+    if streamed:
+        other_contents = [text async for text in stream_note_contents(db, class_id, user_id, content_limit)]
+    else:
+        other_contents = [doc["content"] for doc in facets.get("others", [])]
+    return {
+        # One entry per note; None for notes without content.
+        "student_contents": [doc.get("content") for doc in facets.get("student", [])],
+        "other_contents": other_contents,
+        "other_note_count": other_count,
+        "stored_concepts": stored[0],
+    }
@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+
+# Page size used when a paginated request gives no limit, and the largest one accepted.
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "500"))
+
+
+def encode_cursor(doc: Dict[str, Any], sort_field: Optional[str] = None) -> str:
+    """
+    Opaque cursor pointing just after `doc` in (sort_field, _id) order.
+    """
+    position: Dict[str, Any] = {"id": str(doc["_id"])}
+    if sort_field is not None:
+        value = doc.get(sort_field)
+        position["t"] = value.isoformat() if isinstance(value, datetime) else None
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort_field: Optional[str] = None) -> Dict[str, Any]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        decoded = {"_id": ObjectId(position["id"])}
+        if sort_field is not None:
+            decoded[sort_field] = datetime.fromisoformat(position["t"]) if position.get("t") else None
+        return decoded
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_filter(position: Dict[str, Any], sort_field: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Query matching the documents after `position` in ascending (sort_field, _id) order.
+    Documents without `sort_field` sort first.
+    """
+    after_id = {"_id": {"$gt": position["_id"]}}
+    if sort_field is None:
+        return after_id
+    value = position[sort_field]
+    if value is None:
+        return {"$or": [{sort_field: {"$ne": None}}, {sort_field: None, **after_id}]}
+    return {"$or": [{sort_field: {"$gt": value}}, {sort_field: value, **after_id}]}
+
+
+async def fetch_page(
+    collection,
+    query: Dict[str, Any],
+    projection: Optional[Dict[str, Any]],
+    limit: Optional[int],
+    cursor: Optional[str] = None,
+    sort_field: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    One page of `collection` in (sort_field, _id) order starting after `cursor`.
+    Returns the documents and the cursor of the next page, or None on the last page.
+    With `limit` None, every remaining document is returned as a single page.
+    """
+    if cursor:
+        query = {"$and": [query, keyset_filter(decode_cursor(cursor, sort_field), sort_field)]}
+    sort = ([(sort_field, 1)] if sort_field is not None else []) + [("_id", 1)]
+    if limit is None:
+        return await collection.find(query, projection).sort(sort).to_list(length=None), None
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+    # One extra document tells whether another page follows.
+    docs = await collection.find(query, projection).sort(sort).limit(limit + 1).to_list(length=limit + 1)
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor(docs[-1], sort_field)
+
+
+def page_etag(payload: Any) -> str:
+    """
+    Weak ETag over a response body, so unchanged pages can be answered with 304.
+    """
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return f'W/"{hashlib.sha1(body.encode("utf-8")).hexdigest()}"'
+
+
+async def probe_etag(collection, query: Dict[str, Any], fields: List[str], *extra: Any) -> str:
+    """
+    Weak ETag for a listing of `collection` computed without loading it: the number of
+    documents matching `query` and the newest value of each of `fields`, each answered
+    from an index. Any insert, delete or update that stamps one of `fields` changes it.
+    `extra` (the cursor and page size) is folded in so every page gets its own tag.
+    """
+    probe: List[Any] = [await collection.count_documents(query)]
+    for field in fields:
+        doc = await collection.find_one(query, {field: 1}, sort=[(field, -1)])
+        value = (doc or {}).get(field)
+        # str() because ObjectIds have no JSON encoding.
+        probe.append(None if value is None else str(value))
+    return page_etag([probe, *extra])
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in candidates or etag[2:] in candidates
@@ -0,0 +1,127 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from bson import ObjectId
+from bson.errors import InvalidDocument, InvalidId
+from pymongo.errors import PyMongoError
+
+from app.concept_index import (
+    bump_class_version,
+    invalidate_class_index,
+    phrase_statistics_chunked,
+    record_note_statistics,
+)
+from app.concept_tasks import (
+    DEFAULT_SIMILARITY_METHOD,
+    DEFAULT_SIMILARITY_THRESHOLD,
+    compute_student_concepts,
+    content_version,
+)
+from app.db import get_database_client
+from app.embeddings import pack_embeddings
+from app.extract import calculate_effective_threshold
+from app.vector_index import update_class_vector_index
+from app.workers import run_in_pool
+
+# Lobby default for the number of concepts shown per student.
+DEFAULT_NUM_CONCEPTS = 10
+
+
+def fresh_student_concepts(
+    doc: Optional[Dict[str, Any]],
+    text: str,
+    num_concepts: Optional[int],
+    threshold: float,
+    similarity_method: str,
+    class_size: int = 1
+) -> Optional[List[str]]:
+    """
+    Return stored concepts for `text` if they were computed from this exact content with
+    the same dedup settings, otherwise None.
+    """
+    if not doc or "all_concepts" not in doc:
+        return None
+    if doc.get("content_version") != content_version(text):
+        return None
+    if doc.get("similarity_method") != similarity_method:
+        return None
+    if doc.get("effective_threshold") != calculate_effective_threshold(len(text), threshold, class_size):
+        return None
+    return doc["all_concepts"][:num_concepts]
+
+
+async def store_student_concepts(
+    db,
+    class_id: str,
+    user_id: str,
+    fields: Dict[str, Any],
+    embeddings: Optional[np.ndarray] = None
+) -> None:
+    """
+    Save a student's concept `fields`, then their `embeddings` in a second write, so
+    embeddings that cannot be stored never cost the concept update. The first write drops
+    the previous embeddings, which no longer match the concepts. The class vector index is
+    updated once the embeddings are stored.
+    """
+    key = {"user_id": user_id, "class_id": class_id}
+    update: Dict[str, Any] = {"$set": {**fields, "updated_at": datetime.utcnow()}}
+    if embeddings is not None:
+        update["$unset"] = {"concept_embeddings": ""}
+    await db.student_concepts.update_one(key, update, upsert=True)
+    if embeddings is None:
+        return
+    try:
+        await db.student_concepts.update_one(
+            key, {"$set": {"concept_embeddings": pack_embeddings(embeddings), "updated_at": datetime.utcnow()}}
+        )
+    except (PyMongoError, InvalidDocument) as e:
+        print(f"Could not store concept embeddings for user {user_id} in class {class_id}: {e}")
+        return
+    update_class_vector_index(class_id, user_id, fields["all_concepts"], embeddings)
+
+
+async def _lobby_settings(db, class_id: str) -> Dict[str, Any]:
+    try:
+        lobby = await db.lobbies.find_one({"_id": ObjectId(class_id)}, {"advanced_settings": 1})
+    except InvalidId:
+        lobby = None
+    return (lobby or {}).get("advanced_settings") or {}
+
+
+async def precompute_note(class_id: str, user_id: str, content: str) -> None:
+    """
+    Background job scheduled by /notes/submit-note: update the class concept index with
+    the note and store its concepts and concept embeddings in student_concepts, tagged
+    with the content version they were computed from. The class version is bumped last,
+    once both are in place (or have failed and been invalidated).
+    """
+    async with get_database_client() as client:
+        db = client.notes_db
+        try:
+            statistics = await phrase_statistics_chunked(content)
+            await record_note_statistics(db, class_id, user_id, content, statistics)
+        except Exception as e:
+            print(f"Failed to update class concept index, it will be rebuilt on next read: {e}")
+            await invalidate_class_index(db, class_id)
+
+        try:
+            settings = await _lobby_settings(db, class_id)
+            num_concepts = settings.get("numConceptsStudent", DEFAULT_NUM_CONCEPTS)
+            threshold = settings.get("similarityThresholdUpdate", DEFAULT_SIMILARITY_THRESHOLD)
+            computed = await run_in_pool(
+                compute_student_concepts, content, threshold, DEFAULT_SIMILARITY_METHOD, with_embeddings=True
+            )
+            embeddings = computed.pop("concept_embeddings")
+            computed["concepts"] = computed["all_concepts"][:num_concepts]
+            await store_student_concepts(db, class_id, user_id, computed, embeddings)
+            print(f"Precomputed {len(computed['all_concepts'])} concepts for user {user_id} in class {class_id}")
+        except Exception as e:
+            print(f"Failed to precompute student concepts for user {user_id} in class {class_id}: {e}")
+
+        # Only now invalidate cached analyses: results computed before this point used the old
+        # class statistics and concepts, and must not be cached under the new version.
+        try:
+            await bump_class_version(db, class_id)
+        except Exception as e:
+            print(f"Failed to bump content version of class {class_id}: {e}")
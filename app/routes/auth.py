@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import os
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import List, Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from app.cache import TTLCache
 from app.db import get_database_client
+from app.hashing import password_hash_stats, run_hash
 from motor.motor_asyncio import AsyncIOMotorClient
 
 router = APIRouter()
@@ -15,9 +18,31 @@ SECRET_KEY = "your-secret-key-keep-it-secret"  # In production, use environment
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Authenticated users kept per (username, token) so requests skip the users lookup.
+# Invalidation is per process; the TTL bounds how long other workers serve a changed user.
+AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", "4096"))
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "60"))
+
+# bcrypt work factor (log2 of the iterations). Stored hashes made with any other cost are
+# rehashed at the next successful login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
+user_cache = TTLCache(maxsize=AUTH_USER_CACHE_SIZE, ttl=AUTH_USER_CACHE_TTL)
+# Generation counters bumped by invalidate_user; cached entries of an older generation are
+# never read again. Usernames hash into a fixed number of slots so this stays bounded;
+# invalidating one user also makes the others sharing its slot reload once.
+AUTH_GENERATION_SLOTS = 4096
+_user_generations: List[int] = [0] * AUTH_GENERATION_SLOTS
+
 
 class User(BaseModel):
     username: str
@@ -39,11 +64,19 @@ class SignupRequest(BaseModel):
     user: User
     password: str
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt takes 100ms+ per call, so hashing runs in the hashing thread pool, off the event loop.
+async def verify_password(plain_password, hashed_password):
+    return await run_hash(pwd_context.verify, plain_password, hashed_password)
+
+async def verify_and_update_password(plain_password, hashed_password):
+    """
+    Verify the password and, when the stored hash no longer matches the configured
+    policy (pwd_context.needs_update), also return a fresh hash: (valid, new_hash or None).
+    """
+    return await run_hash(pwd_context.verify_and_update, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await run_hash(pwd_context.hash, password)
 
 async def get_user(db: AsyncIOMotorClient, username: str):
     async with get_database_client() as client:
@@ -51,12 +84,29 @@ async def get_user(db: AsyncIOMotorClient, username: str):
         if user_dict:
             return UserInDB(**user_dict)
 
+def _generation_slot(username: str) -> int:
+    return hash(username) % AUTH_GENERATION_SLOTS
+
+def invalidate_user(username: str) -> None:
+    """
+    Drop every cached session of `username`. Call after every write to auth_db.users,
+    e.g. creating the account, disabling it or changing the password.
+    """
+    _user_generations[_generation_slot(username)] += 1
+
 async def authenticate_user(db: AsyncIOMotorClient, username: str, password: str):
     user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = await verify_and_update_password(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        # Transparently move the stored hash to the configured cost.
+        async with get_database_client() as client:
+            await client.auth_db.users.update_one({"username": username}, {"$set": {"hashed_password": new_hash}})
+        invalidate_user(username)
+        user.hashed_password = new_hash
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -69,7 +119,12 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
+    # Resolved once per request, however many dependencies ask for it.
+    current_user = getattr(request.state, "current_user", None)
+    if current_user is not None:
+        return current_user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -83,9 +138,15 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = await get_user(None, token_data.username)
+
+    cache_key = (token_data.username, _user_generations[_generation_slot(token_data.username)], token)
+    user = user_cache.get(cache_key)
     if user is None:
-        raise credentials_exception
+        user = await get_user(None, token_data.username)
+        if user is None:
+            raise credentials_exception
+        user_cache.set(cache_key, user)
+    request.state.current_user = user
     return user
 
 @router.post("/signup", response_model=User)
@@ -105,12 +166,13 @@ async def signup(request: SignupRequest):
             )
         
         # Create new user
-        hashed_password = get_password_hash(request.password)
+        hashed_password = await get_password_hash(request.password)
         user_dict = request.user.dict()
         user_dict["hashed_password"] = hashed_password
         user_dict["disabled"] = False
         
         result = await client.auth_db.users.insert_one(user_dict)
+        invalidate_user(request.user.username)
         if not result.inserted_id:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -133,4 +195,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         access_token = create_access_token(
             data={"sub": user.username}, expires_delta=access_token_expires
         )
-        return {"access_token": access_token, "token_type": "bearer"} 
\ No newline at end of file
+        return {"access_token": access_token, "token_type": "bearer"}
+
+@router.get("/password-hash-stats", dependencies=[Depends(get_current_user)])
+async def get_password_hash_stats():
+    # This worker's password hashing pool: queue depth and hash/wait latency percentiles.
+    return password_hash_stats()
@@ -1,9 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, Body  # <- Added Body
+from fastapi import APIRouter, Depends, HTTPException, Body, Query, Request, Response  # <- Added Body
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel
 from datetime import datetime
 from typing import Optional, Dict, Any
 from app.db import get_database_client
+from app.pagination import PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, etag_matches, fetch_page, probe_etag
 
 from bson.objectid import ObjectId
 from app.routes.auth import get_current_user
@@ -43,6 +46,7 @@ async def create_lobby(
             "description": payload.description,
             "user_count": payload.user_count,
             "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow(),
             "password": payload.password,
             "advanced_settings": payload.advanced_settings or {
                 "numConceptsStudent": 10,
@@ -126,16 +130,47 @@ async def delete_lobby(
 
         return {"message": "Lobby deleted successfully"}
 
+# Fields returned by the lobby list; the password never leaves the database here.
+LOBBY_LIST_PROJECTION = {
+    "lobby_name": 1,
+    "description": 1,
+    "user_count": 1,
+    "created_by": 1,
+    "created_at": 1,
+    "advanced_settings": 1,
+}
+
+# Fields probed for the lobby list's ETag. Every write to a lobby stamps updated_at.
+LOBBY_PROBE_FIELDS = ["_id", "created_at", "updated_at"]
+
 @router.get("/lobbies")
 async def get_all_lobbies(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,  # X-Next-Cursor of the previous page
+    since: Optional[datetime] = None,  # only lobbies created after this time
     current_user: User = Depends(get_current_user),
     db_client: AsyncIOMotorClient = Depends(get_database_client)
 ):
+    """
+    One page of lobbies in creation order: `limit` (default PAGE_SIZE_DEFAULT) lobbies after
+    `cursor`, with the X-Next-Cursor header carrying the cursor of the next page, absent on
+    the last one. The body is always the list of lobbies. The ETag is derived from a probe
+    of the lobby count and the newest _id, created_at and updated_at, so a matching
+    If-None-Match is answered with 304 before the page itself is loaded.
+    """
+    limit = limit or PAGE_SIZE_DEFAULT
     async with get_database_client() as client:
         db = client.notes_db
-        lobbies_cursor = db.lobbies.find({})
-        lobbies = await lobbies_cursor.to_list(length=None)
-        return [
+        query = {"created_at": {"$gt": since}} if since is not None else {}
+        etag = await probe_etag(db.lobbies, query, LOBBY_PROBE_FIELDS, cursor, limit)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        lobbies, next_cursor = await fetch_page(
+            db.lobbies, query, LOBBY_LIST_PROJECTION, limit, cursor, sort_field="created_at"
+        )
+        page = [
             {
                 "lobby_id": str(lobby["_id"]),
                 "lobby_name": lobby.get("lobby_name", ""),
@@ -153,6 +188,11 @@ async def get_all_lobbies(
             for lobby in lobbies
         ]
 
+    headers = {"ETag": etag}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return JSONResponse(content=jsonable_encoder(page), headers=headers)
+
 @router.put("/lobbies/{lobby_id}/increment-user-count")
 async def increment_user_count(
     lobby_id: str,
@@ -162,7 +202,7 @@ async def increment_user_count(
         db = client.notes_db
         result = await db.lobbies.update_one(
             {"_id": ObjectId(lobby_id)},
-            {"$inc": {"user_count": 1}}
+            {"$inc": {"user_count": 1}, "$set": {"updated_at": datetime.utcnow()}}
         )
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Lobby not found")
@@ -195,7 +235,7 @@ async def update_lobby_settings(
         # Update only the advanced_settings field
         result = await db.lobbies.update_one(
             {"_id": ObjectId(lobby_id)},
-            {"$set": {"advanced_settings": settings_data.get("advanced_settings")}}
+            {"$set": {"advanced_settings": settings_data.get("advanced_settings"), "updated_at": datetime.utcnow()}}
         )
         
         if result.modified_count == 0:
@@ -1,24 +1,66 @@
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, File, UploadFile, Form, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Optional, List, Dict, Any
 from app.db import get_database_client
-from app.extract import extract_key_concepts
+from app.extract import extract_key_concepts, extract_key_concepts_from_statistics
+from app.concept_index import (
+    class_statistics_excluding,
+    get_class_version,
+)
+from app.cache import TTLCache
+from app.llm import LLMCall, LLMUnavailable, get_llm_provider, llm_cache_stats, llm_configured
+from app.llm_metrics import llm_metrics
+from app.note_queries import load_analysis_inputs
+from app.analysis import (
+    basic_detailed_analysis,
+    detailed_prompt,
+    load_detailed_context,
+    parse_detailed_response,
+    run_detailed_analysis,
+)
+from app.jobs import get_analysis_job, job_response, submit_analysis_job
+from app.concept_tasks import compute_student_concepts, compute_student_concepts_batch, embed_concepts
+from app.precompute import (
+    fresh_student_concepts,
+    precompute_note,
+    store_student_concepts,
+)
+from app.compare import compare_concepts
+from app.workers import EXTRACTION_WORKERS, pool_stats
+from bson.errors import InvalidDocument
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from datetime import datetime
+from app.embeddings import embedding_cache_stats, pack_embeddings
+from app.workers import run_in_pool
+from app.vector_index import get_class_vector_index, update_class_vector_index
 import PyPDF2
-import google.generativeai as genai
 import os
 import json
 from dotenv import load_dotenv
 import io
 import re
+import asyncio
+import time
+import numpy as np
 
-# Configure Gemini API – only if key is available
+# Gemini key seen at import time; the SDK itself is configured once by app.llm.
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
 
 router = APIRouter()
 
+# analyze-concepts-enhanced results, keyed by request parameters and class content version.
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "1024"))
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", "600"))
+analysis_cache = TTLCache(maxsize=ANALYSIS_CACHE_SIZE, ttl=ANALYSIS_CACHE_TTL)
+
+# Students per pool task, and concepts per embedding task, in batch-update-student-concepts.
+# Each task must finish within EXTRACTION_TIMEOUT on its own.
+BATCH_STUDENTS_PER_TASK = max(1, int(os.getenv("BATCH_STUDENTS_PER_TASK", "4")))
+BATCH_CONCEPTS_PER_TASK = max(1, int(os.getenv("BATCH_CONCEPTS_PER_TASK", "2000")))
+
 # --- Pydantic model for updating notes (e.g., with High Note enhanced content) ---
 class NotePayload(BaseModel):
     user_id: str
@@ -29,6 +71,7 @@ class NotePayload(BaseModel):
 # /submit-note endpoint: Accepts either text content or a PDF file.
 @router.post("/submit-note")
 async def submit_note(
+    background_tasks: BackgroundTasks,
     user_id: str = Form(...),
     content: str = Form(""),  # optional text input, default empty string
     class_id: str = Form(...),
@@ -63,6 +106,10 @@ async def submit_note(
             {"$set": note_data},
             upsert=True
         )
+        # Index the note and precompute its concepts/embeddings after the response is sent;
+        # that job also bumps the class version, invalidating cached analyses.
+        background_tasks.add_task(precompute_note, class_id, user_id, note_content)
+
         return {
             "message": "Note submitted or updated successfully",
             "modified_count": result.modified_count,
@@ -98,13 +145,23 @@ async def update_student_concepts(
             raise HTTPException(status_code=404, detail="No notes found for this student and class.")
 
         aggregated_text = " ".join([doc["content"] for doc in notes_docs if "content" in doc])
-        concepts = extract_key_concepts(aggregated_text, num_concepts, similarity_threshold, similarity_method)
 
-        await db.student_concepts.update_one(
-            {"user_id": user_id, "class_id": class_id},
-            {"$set": {"concepts": concepts}},
-            upsert=True
-        )
+        # Serve the concepts precomputed at submit time when they match this content and these settings.
+        stored = await db.student_concepts.find_one({"user_id": user_id, "class_id": class_id})
+        concepts = fresh_student_concepts(stored, aggregated_text, num_concepts, similarity_threshold, similarity_method)
+        if concepts is None:
+            computed = await run_in_pool(
+                compute_student_concepts, aggregated_text, similarity_threshold, similarity_method, with_embeddings=True
+            )
+            concepts = computed["all_concepts"][:num_concepts]
+            embeddings = computed.pop("concept_embeddings")
+            await store_student_concepts(db, class_id, user_id, {**computed, "concepts": concepts}, embeddings)
+        else:
+            await db.student_concepts.update_one(
+                {"user_id": user_id, "class_id": class_id},
+                {"$set": {"concepts": concepts}},
+                upsert=True
+            )
         return {
             "message": "Student concepts updated successfully.",
             "user_id": user_id,
@@ -113,44 +170,151 @@ async def update_student_concepts(
         }
 
 # -------------------------------------------------------------------
-# Import sentence_transformers and initialize the model once.
-from sentence_transformers import SentenceTransformer, util
-model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
+# /batch-update-student-concepts endpoint: Refresh concepts for a whole class at once.
+class BatchUpdateConceptsPayload(BaseModel):
+    class_id: str
+    user_ids: Optional[List[str]] = None  # default: every student with notes in the class
+    num_concepts: Optional[int] = 5
+    similarity_threshold: Optional[float] = 0.75
+    similarity_method: Optional[str] = "string"
 
-def find_common_concepts(student_concepts: List[str], other_concepts: List[str], sim_threshold: float = 0.8) -> List[str]:
-    """
-    Compare two lists of concept phrases semantically and return a list of common concepts
-    based on a cosine similarity threshold.
-    """
-    common = set()
-    student_embeddings = model.encode(student_concepts, convert_to_tensor=True)
-    other_embeddings = model.encode(other_concepts, convert_to_tensor=True)
-    for idx, student_emb in enumerate(student_embeddings):
-        cosine_scores = util.cos_sim(student_emb, other_embeddings)
-        if cosine_scores.max().item() >= sim_threshold:
-            common.add(student_concepts[idx])
-    return list(common)
+@router.post("/batch-update-student-concepts")
+async def batch_update_student_concepts(
+    payload: BatchUpdateConceptsPayload,
+    db_client: AsyncIOMotorClient = Depends(get_database_client)
+):
+    class_id = payload.class_id
+    num_concepts = payload.num_concepts
+    similarity_threshold = payload.similarity_threshold
+    similarity_method = payload.similarity_method
+
+    async with db_client as client:
+        db = client.notes_db
+        query = {"class_id": class_id}
+        if payload.user_ids:
+            query["user_id"] = {"$in": payload.user_ids}
+        notes_docs = await db.notes.find(query, {"user_id": 1, "content": 1}).to_list(length=None)
+        if not notes_docs:
+            raise HTTPException(status_code=404, detail="No notes found for this class.")
+
+        texts_by_user: Dict[str, List[str]] = {}
+        for doc in notes_docs:
+            if "content" in doc:
+                texts_by_user.setdefault(doc["user_id"], []).append(doc["content"])
+        aggregated = {user_id: " ".join(texts) for user_id, texts in texts_by_user.items()}
+
+        # Reuse concepts that are already current for a student's content and settings.
+        stored_docs = await db.student_concepts.find(
+            {"class_id": class_id, "user_id": {"$in": list(aggregated)}}
+        ).to_list(length=None)
+        stored = {doc["user_id"]: doc for doc in stored_docs}
+        computed: Dict[str, Dict[str, Any]] = {}
+        stale = []
+        for user_id, text in aggregated.items():
+            if fresh_student_concepts(stored.get(user_id), text, None, similarity_threshold, similarity_method) is None:
+                stale.append(user_id)
+            else:
+                computed[user_id] = {"all_concepts": stored[user_id]["all_concepts"]}
+
+        # Stale students are extracted BATCH_STUDENTS_PER_TASK per pool task, one window of
+        # EXTRACTION_WORKERS tasks at a time, so every task fits in EXTRACTION_TIMEOUT however
+        # large the class is and the pool keeps room for other requests. Each window's
+        # concepts are stored as soon as it finishes, so a failing window keeps earlier work.
+        now = datetime.utcnow()
+        chunks = [stale[i:i + BATCH_STUDENTS_PER_TASK] for i in range(0, len(stale), BATCH_STUDENTS_PER_TASK)]
+        for start in range(0, len(chunks), EXTRACTION_WORKERS):
+            window = chunks[start:start + EXTRACTION_WORKERS]
+            results = await asyncio.gather(*(
+                run_in_pool(compute_student_concepts_batch, [aggregated[u] for u in chunk], similarity_threshold, similarity_method)
+                for chunk in window
+            ), return_exceptions=True)
+            operations = []
+            for chunk, chunk_results in zip(window, results):
+                if isinstance(chunk_results, BaseException):
+                    continue
+                for user_id, result in zip(chunk, chunk_results):
+                    computed[user_id] = result
+                    # The old embeddings no longer match; the new ones follow in a second write.
+                    operations.append(UpdateOne(
+                        {"user_id": user_id, "class_id": class_id},
+                        {
+                            "$set": {**result, "concepts": result["all_concepts"][:num_concepts], "updated_at": now},
+                            "$unset": {"concept_embeddings": ""},
+                        },
+                        upsert=True
+                    ))
+            if operations:
+                await db.student_concepts.bulk_write(operations, ordered=False)
+            for chunk_results in results:
+                if isinstance(chunk_results, BaseException):
+                    raise chunk_results
+
+        reused = [user_id for user_id in computed if user_id not in stale]
+        if reused:
+            await db.student_concepts.bulk_write([
+                UpdateOne(
+                    {"user_id": user_id, "class_id": class_id},
+                    {"$set": {"concepts": computed[user_id]["all_concepts"][:num_concepts], "updated_at": now}},
+                    upsert=True
+                )
+                for user_id in reused
+            ], ordered=False)
+
+        # Recomputed students, and reused ones whose embeddings a failed run left unset, get
+        # embeddings; each distinct concept is embedded once, BATCH_CONCEPTS_PER_TASK per task.
+        unembedded = stale + [user_id for user_id in reused if "concept_embeddings" not in stored[user_id]]
+        distinct_concepts = list(dict.fromkeys(
+            concept for user_id in unembedded for concept in computed[user_id]["all_concepts"]
+        ))
+        concept_chunks = [
+            distinct_concepts[i:i + BATCH_CONCEPTS_PER_TASK]
+            for i in range(0, len(distinct_concepts), BATCH_CONCEPTS_PER_TASK)
+        ]
+        embedding_by_concept = {}
+        for start in range(0, len(concept_chunks), EXTRACTION_WORKERS):
+            window = concept_chunks[start:start + EXTRACTION_WORKERS]
+            for chunk, vectors in zip(window, await asyncio.gather(*(run_in_pool(embed_concepts, chunk) for chunk in window))):
+                embedding_by_concept.update(zip(chunk, vectors))
+
+        # Embeddings are written separately, so a failure here cannot lose the concepts above.
+        embeddings = {
+            user_id: np.asarray([embedding_by_concept[c] for c in computed[user_id]["all_concepts"]], dtype=np.float32)
+            for user_id in unembedded
+        }
+        if embeddings:
+            try:
+                await db.student_concepts.bulk_write([
+                    UpdateOne(
+                        {"user_id": user_id, "class_id": class_id},
+                        {"$set": {"concept_embeddings": pack_embeddings(vectors), "updated_at": now}}
+                    )
+                    for user_id, vectors in embeddings.items()
+                ], ordered=False)
+                for user_id, vectors in embeddings.items():
+                    update_class_vector_index(class_id, user_id, computed[user_id]["all_concepts"], vectors)
+            except (PyMongoError, InvalidDocument) as e:
+                print(f"Could not store concept embeddings for class {class_id}: {e}")
+
+        return {
+            "message": "Student concepts updated successfully.",
+            "class_id": class_id,
+            "recomputed": len(stale),
+            "reused": len(computed) - len(stale),
+            "concepts": {user_id: result["all_concepts"][:num_concepts] for user_id, result in computed.items()}
+        }
 
 # -------------------------------------------------------------------
-async def apply_gemini_filter(result: Dict[str, Any]) -> Dict[str, Any]:
+def gemini_filter_prompt(result: Dict[str, Any]) -> str:
     """
-    Apply Gemini API as a filter layer to enhance the existing analysis.
-    Keeps all original data intact and adds Gemini's insights.
+    Prompt asking Gemini to organise the concept comparison in `result`.
     """
-    if not GEMINI_API_KEY:
-        result["gemini_analysis_error"] = "Gemini API key not configured"
-        return result
+    student_concepts = result.get("student_concepts", [])
+    other_concepts = result.get("other_students_concepts", [])
+    missing_concepts = result.get("missing_concepts", [])
+    extra_concepts = result.get("extra_concepts", [])
+    common_concepts = result.get("common_concepts", [])
 
-    try:
-        gemini_model = genai.GenerativeModel("gemini-1.5-flash")
-        # Prepare context for the Gemini prompt.
-        student_concepts = result.get("student_concepts", [])
-        other_concepts = result.get("other_students_concepts", [])
-        missing_concepts = result.get("missing_concepts", [])
-        extra_concepts = result.get("extra_concepts", [])
-        common_concepts = result.get("common_concepts", [])
-
-        prompt = f"""
+    return f"""
         As an educational assistant, analyze these concept lists from student notes:
 
         Student's concepts: {', '.join(student_concepts) if student_concepts else 'None'}
@@ -166,27 +330,123 @@ async def apply_gemini_filter(result: Dict[str, Any]) -> Dict[str, Any]:
 
         Keep it concise and factual.
         """
-        response = gemini_model.generate_content(prompt)
-        try:
-            gemini_data = json.loads(response.text)
-            if "learningGaps" in gemini_data and gemini_data["learningGaps"]:
-                result["missing_concepts"] = gemini_data["learningGaps"]
-                result["original_missing_concepts"] = missing_concepts
-            else:
-                result["gemini_analysis_error"] = "No learning gaps found in Gemini response"
-            result["gemini_analysis"] = gemini_data
-        except json.JSONDecodeError:
-            result["gemini_analysis_error"] = "Failed to parse Gemini response as JSON"
-            result["gemini_raw_response"] = response.text
+
+def merge_gemini_filter(result: Dict[str, Any], response_text: str) -> Dict[str, Any]:
+    """
+    Add Gemini's analysis to `result`, replacing missing_concepts with its learning gaps.
+    """
+    missing_concepts = result.get("missing_concepts", [])
+    try:
+        gemini_data = json.loads(response_text)
+        if "learningGaps" in gemini_data and gemini_data["learningGaps"]:
+            result["missing_concepts"] = gemini_data["learningGaps"]
+            result["original_missing_concepts"] = missing_concepts
+        else:
+            result["gemini_analysis_error"] = "No learning gaps found in Gemini response"
+        result["gemini_analysis"] = gemini_data
+    except json.JSONDecodeError:
+        result["gemini_analysis_error"] = "Failed to parse Gemini response as JSON"
+        result["gemini_raw_response"] = response_text
+    return result
+
+async def apply_gemini_filter(result: Dict[str, Any], llm_calls: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Apply Gemini API as a filter layer to enhance the existing analysis.
+    Keeps all original data intact and adds Gemini's insights.
+    The instrumented call's summary is appended to `llm_calls` when given.
+    """
+    if not llm_configured():
+        result["gemini_analysis_error"] = "Gemini API key not configured"
         return result
+
+    call = LLMCall("analyze-concepts-enhanced")
+    try:
+        async with call:
+            response_text = await call.generate(gemini_filter_prompt(result))
+            result = merge_gemini_filter(result, response_text)
+            if "gemini_raw_response" in result:
+                call.outcome = "json_parse_failure"
     except Exception as e:
         result["gemini_analysis_error"] = str(e)
-        return result
+    if llm_calls is not None:
+        llm_calls.append(call.summary())
+    return result
+
+# -------------------------------------------------------------------
+async def analysis_cache_key(db, user_id: str, class_id: str, *params) -> tuple:
+    """
+    Key for analysis_cache: the request parameters plus the class content version.
+    """
+    return (class_id, user_id, *params, await get_class_version(db, class_id))
+
+def cache_analysis(cache_key: tuple, result: Dict[str, Any]) -> None:
+    # Gemini failures are usually transient, so those results are not cached.
+    if "gemini_analysis_error" not in result or not llm_configured():
+        analysis_cache.set(cache_key, result)
+
+async def local_concept_analysis(
+    db,
+    user_id: str,
+    class_id: str,
+    num_concepts: Optional[int],
+    similarity_threshold: float,
+    similarity_method: str,
+    sim_threshold: float
+) -> Dict[str, Any]:
+    """
+    The part of analyze-concepts-enhanced computed without Gemini: both concept lists and
+    their semantic comparison.
+    """
+    # Classmates' RAKE statistics come from the incremental class index rather than
+    # re-running RAKE over every other note in the class.
+    other_statistics = await class_statistics_excluding(db, class_id, user_id)
+
+    # The student's notes and stored concepts in one round trip.
+    inputs = await load_analysis_inputs(db, user_id, class_id)
+
+    if other_statistics["note_count"] <= 0:
+        raise HTTPException(status_code=404, detail="No notes found from other students.")
+    if not inputs["student_contents"]:
+        raise HTTPException(status_code=404, detail="No notes found for this student.")
+
+    # Optionally, adjust threshold dynamically based on class size.
+    class_size = other_statistics["note_count"] + 1  # include current student
+
+    aggregated_student_text = " ".join(content for content in inputs["student_contents"] if content is not None)
+
+    student_concepts = fresh_student_concepts(
+        inputs["stored_concepts"], aggregated_student_text, num_concepts, similarity_threshold, similarity_method, class_size
+    )
+    other_concepts_task = run_in_pool(
+        extract_key_concepts_from_statistics,
+        other_statistics["statistics"], other_statistics["text_length"],
+        num_concepts, similarity_threshold, similarity_method, class_size
+    )
+    if student_concepts is None:
+        other_concepts, student_concepts = await asyncio.gather(
+            other_concepts_task,
+            run_in_pool(extract_key_concepts, aggregated_student_text, num_concepts, similarity_threshold, similarity_method, class_size)
+        )
+    else:
+        other_concepts = await other_concepts_task
+
+    # Common, missing and extra concepts all come from one semantic similarity matrix.
+    comparison = await run_in_pool(compare_concepts, student_concepts, other_concepts, sim_threshold=sim_threshold)
+
+    return {
+        "other_students_concepts": other_concepts,
+        "student_concepts": student_concepts,
+        "missing_concepts": comparison["missing_concepts"],
+        "extra_concepts": comparison["extra_concepts"],
+        "common_concepts": comparison["common_concepts"],
+        "common_concept_matches": comparison["common_concept_matches"]
+    }
 
 # -------------------------------------------------------------------
 # /analyze-concepts-enhanced endpoint: Extract and compare student and other students’ concepts.
 @router.get("/analyze-concepts-enhanced")
 async def analyze_concepts_enhanced(
+    response: Response,
     user_id: str,
     class_id: str,
     num_concepts: Optional[int] = 10,
@@ -194,54 +454,167 @@ async def analyze_concepts_enhanced(
     similarity_method: Optional[str] = "string",  # may be unused with semantic compare
     sim_threshold: float = 0.8,  # threshold for common concepts using semantic similarity
     use_gemini: bool = True,
+    include_timing: bool = False,  # add a "timing" block with latency and LLM call details
     db_client: AsyncIOMotorClient = Depends(get_database_client)
 ):
+    started = time.perf_counter()
+    llm_calls: List[Dict[str, Any]] = []
     async with db_client as client:
         db = client.notes_db
 
-        other_notes_docs = await db.notes.find({
-            "class_id": class_id,
-            "user_id": {"$ne": user_id}
-        }).to_list(length=None)
-
-        student_notes_docs = await db.notes.find({
-            "class_id": class_id,
-            "user_id": user_id
-        }).to_list(length=None)
+        # Nothing in the class changed since this exact request was answered: serve it again.
+        cache_key = await analysis_cache_key(
+            db, user_id, class_id, num_concepts, similarity_threshold, similarity_method, sim_threshold, use_gemini
+        )
+        cached = analysis_cache.get(cache_key)
+        if cached is not None:
+            response.headers["X-Cache"] = "HIT"
+            result = {**cached, "cache_hit": True}
+        else:
+            result = await local_concept_analysis(
+                db, user_id, class_id, num_concepts, similarity_threshold, similarity_method, sim_threshold
+            )
+            if use_gemini:
+                print("Applying Gemini filter")
+                result = await apply_gemini_filter(result, llm_calls)
+            print("Result: ", result)
+            cache_analysis(cache_key, result)
+            response.headers["X-Cache"] = "MISS"
+            result = {**result, "cache_hit": False}
+
+        if include_timing:
+            result["timing"] = timing_block(started, llm_calls)
+        return result
 
-        if not other_notes_docs:
-            raise HTTPException(status_code=404, detail="No notes found from other students.")
-        if not student_notes_docs:
-            raise HTTPException(status_code=404, detail="No notes found for this student.")
+def timing_block(started: float, llm_calls: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Per-response timing: total handler time and the instrumented LLM calls it made.
+    """
+    return {
+        "total_ms": round((time.perf_counter() - started) * 1000, 2),
+        "llm_ms": round(sum(call["latency_ms"] for call in llm_calls), 2),
+        "llm_calls": llm_calls,
+    }
 
-        # Optionally, adjust threshold dynamically based on class size.
-        class_size = len(other_notes_docs) + 1  # include current student
+# -------------------------------------------------------------------
+# Server-sent events: cheap local results first, then Gemini's output as it is generated,
+# then the final parsed result.
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-        aggregated_other_text = " ".join(doc["content"] for doc in other_notes_docs if "content" in doc)
-        aggregated_student_text = " ".join(doc["content"] for doc in student_notes_docs if "content" in doc)
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
 
-        # Extract concepts using your extraction function;
-        # In the merged version, you may pass class_size if your function supports it.
-        other_concepts = extract_key_concepts(aggregated_other_text, num_concepts, similarity_threshold, similarity_method, class_size)
-        student_concepts = extract_key_concepts(aggregated_student_text, num_concepts, similarity_threshold, similarity_method, class_size)
+@router.get("/analyze-concepts-enhanced/stream")
+async def analyze_concepts_enhanced_stream(
+    user_id: str,
+    class_id: str,
+    num_concepts: Optional[int] = 10,
+    similarity_threshold: Optional[float] = 0.75,
+    similarity_method: Optional[str] = "string",
+    sim_threshold: float = 0.8,
+    use_gemini: bool = True,
+    db_client: AsyncIOMotorClient = Depends(get_database_client)
+):
+    """
+    Streaming variant of /analyze-concepts-enhanced. Events: "concepts" (local concept
+    comparison), "gemini" (text chunks, when use_gemini), "result" (the same body the
+    non-streaming endpoint returns), then "done".
+    """
+    async with db_client as client:
+        db = client.notes_db
+        cache_key = await analysis_cache_key(
+            db, user_id, class_id, num_concepts, similarity_threshold, similarity_method, sim_threshold, use_gemini
+        )
+        cached = analysis_cache.get(cache_key)
+        result = cached or await local_concept_analysis(
+            db, user_id, class_id, num_concepts, similarity_threshold, similarity_method, sim_threshold
+        )
 
-        common_concepts = find_common_concepts(student_concepts, other_concepts, sim_threshold=sim_threshold)
+    async def events():
+        yield sse_event("concepts", {
+            "student_concepts": result["student_concepts"],
+            "other_students_concepts": result["other_students_concepts"],
+            "common_concepts": result["common_concepts"],
+            "common_concept_matches": result["common_concept_matches"],
+            "missing_concepts": result.get("original_missing_concepts", result["missing_concepts"]),
+            "extra_concepts": result["extra_concepts"],
+        })
+        if cached is not None:
+            yield sse_event("result", {**cached, "cache_hit": True})
+            yield sse_event("done", {})
+            return
+
+        final = result
+        if use_gemini and not llm_configured():
+            final = {**result, "gemini_analysis_error": "Gemini API key not configured"}
+        elif use_gemini:
+            parts = []
+            call = LLMCall("analyze-concepts-enhanced/stream")
+            try:
+                async with call:
+                    async for chunk in call.stream(gemini_filter_prompt(result)):
+                        parts.append(chunk)
+                        yield sse_event("gemini", {"text": chunk})
+                    final = merge_gemini_filter(dict(result), "".join(parts))
+                    if "gemini_raw_response" in final:
+                        call.outcome = "json_parse_failure"
+            except Exception as e:
+                final = {**result, "gemini_analysis_error": str(e)}
+        cache_analysis(cache_key, final)
+        yield sse_event("result", {**final, "cache_hit": False})
+        yield sse_event("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
 
-        missing_concepts = list(set(other_concepts) - set(student_concepts))
-        extra_concepts = list(set(student_concepts) - set(other_concepts))
+# -------------------------------------------------------------------
+# /concept-neighbors endpoint: k-NN lookups against the class concept vector index.
+# With `concept`, returns the closest concepts in the class and which classmates wrote them;
+# with only `user_id`, returns the closest classmates' concepts for each of that student's concepts.
+@router.get("/concept-neighbors")
+async def concept_neighbors(
+    class_id: str,
+    concept: Optional[str] = None,
+    user_id: Optional[str] = None,
+    k: int = 10,
+    nprobe: Optional[int] = None,
+    db_client: AsyncIOMotorClient = Depends(get_database_client)
+):
+    if not concept and not user_id:
+        raise HTTPException(status_code=400, detail="Provide a concept or a user_id to query.")
+    if k < 1:
+        raise HTTPException(status_code=400, detail="k must be at least 1.")
 
-        result = {
-            "other_students_concepts": other_concepts,
-            "student_concepts": student_concepts,
-            "missing_concepts": missing_concepts,
-            "extra_concepts": extra_concepts,
-            "common_concepts": common_concepts
+    async with db_client as client:
+        db = client.notes_db
+        index = await get_class_vector_index(db, class_id)
+    if index is None or len(index) == 0:
+        raise HTTPException(status_code=404, detail="No concept embeddings found for this class.")
+
+    if concept:
+        query = await run_in_pool(embed_concepts, [concept])
+        start = time.perf_counter()
+        neighbors = index.search(np.asarray(query), k, exclude_group=user_id, nprobe=nprobe)[0]
+        search_ms = (time.perf_counter() - start) * 1000
+        return {
+            "class_id": class_id,
+            "concept": concept,
+            "neighbors": neighbors,
+            "classmates": list(dict.fromkeys(neighbor["user_id"] for neighbor in neighbors)),
+            "search_ms": round(search_ms, 3)
         }
-        if use_gemini:
-            print("Applying Gemini filter")
-            result = await apply_gemini_filter(result)
-        print("Result: ", result)
-        return result
+
+    labels = index.group_labels(user_id)
+    if not labels:
+        raise HTTPException(status_code=404, detail="No concept embeddings found for this student.")
+    start = time.perf_counter()
+    results = index.search(index.group_vectors(user_id), k, exclude_group=user_id, nprobe=nprobe)
+    search_ms = (time.perf_counter() - start) * 1000
+    return {
+        "class_id": class_id,
+        "user_id": user_id,
+        "concepts": [{"concept": label, "neighbors": neighbors} for label, neighbors in zip(labels, results)],
+        "search_ms": round(search_ms, 3)
+    }
 
 # -------------------------------------------------------------------
 #
@@ -274,15 +647,17 @@ async def get_student_notes(
 async def detailed_note_analysis(
     user_id: str,
     class_id: str,
+    include_timing: bool = False,  # add a "timing" block with latency and LLM call details
     db_client: AsyncIOMotorClient = Depends(get_database_client)
 ):
+    started = time.perf_counter()
     print(f"Starting detailed note analysis for user {user_id} in class {class_id}")
     load_dotenv()  # Explicitly load environment variables
     api_key = os.environ.get('GEMINI_API_KEY')
     print(f"API key loaded directly: {bool(api_key)}")
     print(f"API key length: {len(api_key) if api_key else 0}")
 
-    if not api_key:
+    if not llm_configured():
         raise HTTPException(
             status_code=400,
             detail="Gemini API key not configured. Please add GEMINI_API_KEY to your environment variables."
@@ -290,141 +665,15 @@ async def detailed_note_analysis(
     try:
         async with db_client as client:
             db = client.notes_db
-
-            student_notes = await db.notes.find({
-                "user_id": user_id,
-                "class_id": class_id
-            }).to_list(length=None)
-            if not student_notes:
-                raise HTTPException(status_code=404, detail="No notes found for this student in this class.")
-
-            other_students_notes = await db.notes.find({
-                "class_id": class_id,
-                "user_id": {"$ne": user_id}
-            }).to_list(length=None)
-            if not other_students_notes:
-                print("No other students' notes found for comparison. Proceeding with analysis of just this student's notes.")
-                other_students_notes = []
-
-            student_content = " ".join([note["content"] for note in student_notes if "content" in note])
-            print(f"Student content length: {len(student_content)}")
-            other_content = " ".join([note["content"] for note in other_students_notes if "content" in note])
-            print(f"Other students' content length: {len(other_content)}")
-
-            student_concepts_doc = await db.student_concepts.find_one({"user_id": user_id, "class_id": class_id})
-            student_concepts = student_concepts_doc.get("concepts", []) if student_concepts_doc else []
-            print(f"Student concepts: {student_concepts}")
-
-            student_content_condensed = student_content[:3000] if len(student_content) > 3000 else student_content
-            other_content_condensed = other_content[:3000] if len(other_content) > 3000 else other_content
-
-            try:
-                print("Initializing Gemini model...")
-                genai.configure(api_key=api_key)
-                gemini_model = genai.GenerativeModel("gemini-1.5-flash")
-
-                # Updated prompt: always request strengthsAndWeaknesses regardless of whether other notes exist.
-                if other_students_notes:
-                    prompt = f"""
-                    As an educational assistant, analyze these notes and focus on extracting valuable information from the dataset to enhance the student's notes.
-
-                    STUDENT'S NOTES (TO BE ENHANCED):
-                    {student_content_condensed}
-
-                    DATASET (NOTES FROM OTHER STUDENTS FOR REFERENCE):
-                    {other_content_condensed}
-
-                    EXTRACTED KEY CONCEPTS FROM STUDENT'S NOTES:
-                    {', '.join(student_concepts)}
-
-                    EXTRACTED KEY CONCEPTS FROM DATASET:
-                    {', '.join(extract_key_concepts(other_content))}
-
-                    Provide a JSON response with the following structure:
-                    {{
-                        "topicCoverage": [...],
-                        "missingTopics": [...],
-                        "datasetKnowledge": [...],
-                        "qualityAssessment": "...",
-                        "strengthsAndWeaknesses": {{
-                            "strengths": [...],
-                            "weaknesses": [...]
-                        }},
-                        "studyRecommendations": [...]
-                    }}
-                    """
-                else:
-                    prompt = f"""
-                    As an educational assistant, analyze these student notes and provide feedback.
-
-                    STUDENT'S NOTES:
-                    {student_content_condensed}
-
-                    EXTRACTED KEY CONCEPTS FROM STUDENT'S NOTES:
-                    {', '.join(student_concepts)}
-
-                    Provide a JSON response with the following structure:
-                    {{
-                        "topicCoverage": [...],
-                        "missingTopics": [...],
-                        "datasetKnowledge": [...],
-                        "qualityAssessment": "...",
-                        "strengthsAndWeaknesses": {{
-                            "strengths": [...],
-                            "weaknesses": [...]
-                        }},
-                        "studyRecommendations": [...]
-                    }}
-                    """
-                print("Sending prompt to Gemini API...")
-                print(f"Prompt length: {len(prompt)}")
-                response = gemini_model.generate_content(prompt)
-                print(f"Received response from Gemini API: {response.text[:100]}...")
-                try:
-                    analysis = json.loads(response.text)
-                    return {
-                        "status": "success",
-                        "student_id": user_id,
-                        "class_id": class_id,
-                        "analysis": analysis
-                    }
-                except json.JSONDecodeError as json_err:
-                    print(f"JSON parsing error: {json_err}")
-                    print(f"Raw response: {response.text}")
-                    match = re.search(r'(\{.*\})', response.text, re.DOTALL)
-                    if match:
-                        try:
-                            json_str = match.group(1)
-                            analysis = json.loads(json_str)
-                            return {
-                                "status": "success",
-                                "student_id": user_id,
-                                "class_id": class_id,
-                                "analysis": analysis
-                            }
-                        except Exception as ex:
-                            print(f"Failed to parse extracted JSON: {ex}")
-                    return {
-                        "status": "partial_success",
-                        "student_id": user_id,
-                        "class_id": class_id,
-                        "raw_analysis": response.text,
-                        "basic_analysis": {
-                            "topicCoverage": student_concepts,
-                            "qualityAssessment": "Analysis not available - please check raw_analysis field",
-                            "strengthsAndWeaknesses": {"strengths": [], "weaknesses": []},
-                            "studyRecommendations": []
-                        },
-                        "error": "Failed to parse response as JSON"
-                    }
-            except Exception as gemini_err:
-                print(f"Gemini API error: {gemini_err}")
-                return {
-                    "status": "error",
-                    "message": str(gemini_err),
-                    "details": "Error occurred while processing Gemini API request"
-                }
+            llm_calls: List[Dict[str, Any]] = []
+            result = await run_detailed_analysis(db, user_id, class_id, llm_calls)
+            if include_timing:
+                result["timing"] = timing_block(started, llm_calls)
+            return result
     except Exception as general_err:
+        # A saturated or timed-out extraction pool must reach the client as a real 503/504.
+        if isinstance(general_err, HTTPException) and general_err.status_code in (503, 504):
+            raise
         print(f"General error in detailed_note_analysis: {general_err}")
         return {
             "status": "error",
@@ -433,6 +682,122 @@ async def detailed_note_analysis(
         }
 
 
+# -------------------------------------------------------------------
+# /detailed-note-analysis/stream endpoint: Streaming variant of /detailed-note-analysis.
+@router.get("/detailed-note-analysis/stream")
+async def detailed_note_analysis_stream(
+    user_id: str,
+    class_id: str,
+    db_client: AsyncIOMotorClient = Depends(get_database_client)
+):
+    """
+    Events: "concepts" (the student's and classmates' key concepts), "gemini" (text
+    chunks as Gemini generates them), "result" (the same body /detailed-note-analysis
+    returns), then "done".
+    """
+    if not llm_configured():
+        raise HTTPException(
+            status_code=400,
+            detail="Gemini API key not configured. Please add GEMINI_API_KEY to your environment variables."
+        )
+    async with db_client as client:
+        db = client.notes_db
+        context = await load_detailed_context(db, user_id, class_id)
+
+    async def events():
+        yield sse_event("concepts", {
+            "student_concepts": context["student_concepts"],
+            "other_key_concepts": context["other_key_concepts"],
+        })
+        parts = []
+        call = LLMCall("detailed-note-analysis/stream")
+        try:
+            async with call:
+                async for chunk in call.stream(detailed_prompt(context)):
+                    parts.append(chunk)
+                    yield sse_event("gemini", {"text": chunk})
+                result = {**parse_detailed_response(context, "".join(parts)), "condensation": context["condensation"]}
+                if result["status"] != "success":
+                    call.outcome = "json_parse_failure"
+        except LLMUnavailable as llm_err:
+            result = {**basic_detailed_analysis(context, str(llm_err)), "condensation": context["condensation"]}
+        except Exception as gemini_err:
+            print(f"Gemini API error: {gemini_err}")
+            result = {
+                "status": "error",
+                "message": str(gemini_err),
+                "details": "Error occurred while processing Gemini API request"
+            }
+        yield sse_event("result", result)
+        yield sse_event("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# -------------------------------------------------------------------
+# /analysis-jobs endpoints: Job-based variant of /detailed-note-analysis.
+# POST returns at once with a job id; the job's result is stored in Mongo and reused for
+# repeat requests until a note in the class changes.
+class AnalysisJobPayload(BaseModel):
+    user_id: str
+    class_id: str
+
+@router.post("/analysis-jobs", status_code=202)
+async def create_analysis_job(
+    payload: AnalysisJobPayload,
+    db_client: AsyncIOMotorClient = Depends(get_database_client)
+):
+    if not llm_configured():
+        raise HTTPException(
+            status_code=400,
+            detail="Gemini API key not configured. Please add GEMINI_API_KEY to your environment variables."
+        )
+    async with db_client as client:
+        db = client.notes_db
+        job = await submit_analysis_job(db, payload.user_id, payload.class_id)
+        return job_response(job)
+
+@router.get("/analysis-jobs/{job_id}")
+async def get_analysis_job_status(
+    job_id: str,
+    db_client: AsyncIOMotorClient = Depends(get_database_client)
+):
+    async with db_client as client:
+        db = client.notes_db
+        job = await get_analysis_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+    return job_response(job)
+
+
+# -------------------------------------------------------------------
+# /embedding-cache-stats endpoint: Report the phrase-embedding cache counters of this process and its pool workers.
+@router.get("/embedding-cache-stats")
+async def get_embedding_cache_stats():
+    return embedding_cache_stats()
+
+
+# -------------------------------------------------------------------
+# /extraction-pool-stats endpoint: Report the extraction process pool's size and tasks in flight.
+@router.get("/extraction-pool-stats")
+async def get_extraction_pool_stats():
+    return pool_stats()
+
+
+# -------------------------------------------------------------------
+# /llm-cache-stats endpoint: Report this worker's Gemini response cache counters.
+@router.get("/llm-cache-stats")
+async def get_llm_cache_stats():
+    return llm_cache_stats()
+
+
+# -------------------------------------------------------------------
+# /llm-metrics endpoint: Per-endpoint LLM latency, tokens, cost and outcomes for this worker.
+@router.get("/llm-metrics")
+async def get_llm_metrics():
+    return llm_metrics()
+
+
 # -------------------------------------------------------------------
 # /check-environment endpoint: Debug and report environment details.
 @router.get("/check-environment")
@@ -450,6 +815,8 @@ async def check_environment():
         "router_api_key_exists": bool(router_api_key),
         "router_api_key_length": len(router_api_key) if router_api_key else 0,
         "gemini_module_loaded": gemini_loaded,
+        "llm_provider": get_llm_provider().name,
+        "llm_configured": llm_configured(),
         "python_version": sys.version,
         "working_directory": os.getcwd(),
         "env_file_exists": os.path.exists('.env'),
@@ -0,0 +1,273 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.cache import TTLCache
+from app.embeddings import unpack_embeddings
+
+# Vectors needed before the index is split into clusters; below this every query is an
+# exact scan, which is already well under a millisecond.
+VECTOR_INDEX_MIN_TRAIN = int(os.getenv("VECTOR_INDEX_MIN_TRAIN", "2048"))
+# Number of clusters scanned per query. Higher is more accurate and slower.
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+# Seconds between checks of student_concepts for concepts written by other processes.
+VECTOR_INDEX_REFRESH = float(os.getenv("VECTOR_INDEX_REFRESH", "30"))
+# Number of class indexes kept in memory per process.
+VECTOR_INDEX_MAX_CLASSES = int(os.getenv("VECTOR_INDEX_MAX_CLASSES", "256"))
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _kmeans(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means on a sample of unit vectors; returns `nlist` unit centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), nlist * 64), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = (sample @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        filled = np.bincount(assignment, minlength=nlist) > 0
+        centroids[filled] = _normalize(sums[filled])
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index for cosine similarity over unit-normalized vectors.
+
+    Every vector belongs to a group (a student) and carries a label (the concept). Vectors
+    are assigned to the nearest of ~sqrt(n) k-means centroids and a query scans only the
+    `nprobe` closest clusters, so query cost stays roughly flat as the class grows.
+    Replacing a group marks its old rows deleted; the index is compacted and re-clustered
+    when deleted rows outnumber live ones or the live set doubles since the last training.
+    """
+
+    def __init__(self, dimension: int, nprobe: int = VECTOR_INDEX_NPROBE):
+        self.dimension = dimension
+        self.nprobe = nprobe
+        self._reset(np.zeros((0, dimension), dtype=np.float32), [], [])
+
+    def _reset(self, vectors: np.ndarray, groups: List[str], labels: List[str]) -> None:
+        self._vectors = vectors
+        self._size = len(vectors)
+        self._alive = np.ones(len(vectors), dtype=bool)
+        self._row_groups = list(groups)
+        self._labels = list(labels)
+        self._groups: Dict[str, List[int]] = {}
+        for row, group in enumerate(groups):
+            self._groups.setdefault(group, []).append(row)
+        self._live = len(vectors)
+
+        nlist = int(np.sqrt(len(vectors))) if len(vectors) >= VECTOR_INDEX_MIN_TRAIN else 1
+        if nlist > 1:
+            self._centroids = _kmeans(vectors, nlist)
+            assignment = (vectors @ self._centroids.T).argmax(axis=1)
+        else:
+            self._centroids = np.zeros((1, self.dimension), dtype=np.float32)
+            assignment = np.zeros(len(vectors), dtype=np.int64)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        self._lists: List[List[int]] = [order[bounds[c]:bounds[c + 1]].tolist() for c in range(nlist)]
+        self._list_arrays: List[Optional[np.ndarray]] = [None] * nlist
+        self._trained_size = len(vectors)
+
+    def __len__(self) -> int:
+        return self._live
+
+    @property
+    def nlist(self) -> int:
+        return len(self._lists)
+
+    def groups(self) -> List[str]:
+        return list(self._groups)
+
+    def group_vectors(self, group: str) -> np.ndarray:
+        return self._vectors[self._groups.get(group, [])]
+
+    def group_labels(self, group: str) -> List[str]:
+        return [self._labels[row] for row in self._groups.get(group, [])]
+
+    def _compact(self) -> None:
+        rows = np.flatnonzero(self._alive[:self._size])
+        self._reset(
+            self._vectors[rows],
+            [self._row_groups[row] for row in rows],
+            [self._labels[row] for row in rows]
+        )
+
+    def remove_group(self, group: str) -> None:
+        rows = self._groups.pop(group, [])
+        self._alive[rows] = False
+        self._live -= len(rows)
+        if self._size - self._live > max(self._live, 64):
+            self._compact()
+
+    def set_group(self, group: str, vectors: np.ndarray, labels: List[str]) -> None:
+        """
+        Replace the vectors stored for `group` (incremental update for one student).
+        """
+        self.remove_group(group)
+        if not labels:
+            return
+        vectors = _normalize(vectors)
+        count = len(vectors)
+        if self._size + count > len(self._vectors):
+            capacity = max(2 * len(self._vectors), self._size + count, 64)
+            grown = np.zeros((capacity, self.dimension), dtype=np.float32)
+            grown[:self._size] = self._vectors[:self._size]
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:self._size] = self._alive[:self._size]
+            self._vectors, self._alive = grown, alive
+
+        rows = list(range(self._size, self._size + count))
+        self._vectors[rows] = vectors
+        self._alive[rows] = True
+        self._row_groups.extend([group] * count)
+        self._labels.extend(labels)
+        self._groups[group] = rows
+        self._size += count
+        self._live += count
+
+        assignment = (vectors @ self._centroids.T).argmax(axis=1)
+        for row, cluster in zip(rows, assignment):
+            self._lists[cluster].append(row)
+            self._list_arrays[cluster] = None
+
+        if self._live >= VECTOR_INDEX_MIN_TRAIN and self._live >= 2 * max(self._trained_size, VECTOR_INDEX_MIN_TRAIN // 2):
+            self._compact()
+
+    def _list_array(self, cluster: int) -> np.ndarray:
+        array = self._list_arrays[cluster]
+        if array is None:
+            array = self._list_arrays[cluster] = np.asarray(self._lists[cluster], dtype=np.int64)
+        return array
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 10,
+        exclude_group: Optional[str] = None,
+        nprobe: Optional[int] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Return the k nearest stored concepts for each query vector, best first, as
+        {"concept", "user_id", "score"} dicts.
+        """
+        queries = _normalize(queries)
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        if self.nlist > 1:
+            probes = np.argpartition(-(queries @ self._centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.zeros((len(queries), 1), dtype=np.int64)
+        excluded = np.asarray(self._groups.get(exclude_group, []), dtype=np.int64)
+
+        results = []
+        for query, clusters in zip(queries, probes):
+            candidates = np.concatenate([self._list_array(c) for c in clusters])
+            candidates = candidates[self._alive[candidates]]
+            if len(excluded):
+                candidates = candidates[~np.isin(candidates, excluded)]
+            if not len(candidates):
+                results.append([])
+                continue
+            scores = self._vectors[candidates] @ query
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results.append([
+                {
+                    "concept": self._labels[candidates[i]],
+                    "user_id": self._row_groups[candidates[i]],
+                    "score": round(float(scores[i]), 4),
+                }
+                for i in top
+            ])
+        return results
+
+
+# -------------------------------------------------------------------
+# Per-class indexes built from student_concepts.concept_embeddings.
+class _ClassEntry:
+    def __init__(self):
+        self.index: Optional[IVFIndex] = None
+        self.synced_at: Optional[datetime] = None
+        self.checked_at = 0.0
+
+
+_class_indexes = TTLCache(maxsize=VECTOR_INDEX_MAX_CLASSES)
+_class_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _apply_concepts(entry: _ClassEntry, user_id: str, concepts: List[str], embeddings: Optional[np.ndarray]) -> None:
+    if embeddings is None or len(concepts) != len(embeddings):
+        # Concepts recomputed without embeddings; the next precompute brings them back in step.
+        return
+    if entry.index is not None and entry.index.group_labels(user_id) == concepts:
+        return
+    if entry.index is None:
+        if not len(embeddings):
+            return
+        entry.index = IVFIndex(embeddings.shape[1])
+    entry.index.set_group(user_id, embeddings, concepts)
+
+
+async def _sync(db, class_id: str, entry: _ClassEntry) -> None:
+    query: Dict[str, Any] = {"class_id": class_id, "concept_embeddings": {"$exists": True}}
+    if entry.synced_at is not None:
+        query["updated_at"] = {"$gte": entry.synced_at}
+    cursor = db.student_concepts.find(
+        query, {"user_id": 1, "all_concepts": 1, "concept_embeddings": 1, "updated_at": 1}
+    )
+    async for doc in cursor:
+        concepts = doc.get("all_concepts") or []
+        _apply_concepts(entry, doc["user_id"], concepts, unpack_embeddings(doc.get("concept_embeddings"), len(concepts)))
+        updated_at = doc.get("updated_at")
+        if updated_at is not None and (entry.synced_at is None or updated_at > entry.synced_at):
+            entry.synced_at = updated_at
+    entry.checked_at = time.monotonic()
+
+
+async def get_class_vector_index(db, class_id: str) -> Optional[IVFIndex]:
+    """
+    Return the concept vector index for a class, building it from student_concepts on
+    first use. Afterwards only documents updated since the last check are read, at most
+    once every VECTOR_INDEX_REFRESH seconds. Returns None if no student has embeddings.
+    """
+    entry = _class_indexes.get(class_id)
+    if entry is not None and time.monotonic() - entry.checked_at < VECTOR_INDEX_REFRESH:
+        return entry.index
+
+    lock = _class_locks.setdefault(class_id, asyncio.Lock())
+    async with lock:
+        entry = _class_indexes.get(class_id)
+        if entry is None:
+            entry = _ClassEntry()
+            await _sync(db, class_id, entry)
+            _class_indexes.set(class_id, entry)
+        elif time.monotonic() - entry.checked_at >= VECTOR_INDEX_REFRESH:
+            await _sync(db, class_id, entry)
+    return entry.index
+
+
+def update_class_vector_index(
+    class_id: str,
+    user_id: str,
+    concepts: List[str],
+    embeddings: np.ndarray
+) -> None:
+    """
+    Apply a student's freshly computed concepts to the class index, if this process has
+    one loaded. Other processes pick the change up on their next refresh.
+    """
+    entry = _class_indexes.get(class_id)
+    if entry is not None:
+        _apply_concepts(entry, user_id, concepts, embeddings)
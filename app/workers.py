@@ -0,0 +1,106 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException
+
+from app.embeddings import record_worker_cache_stats, run_counting_cache_stats
+from app.extract import NLTKResourceMissing
+
+# Worker processes for CPU-bound concept extraction and embedding work.
+EXTRACTION_WORKERS = max(1, int(os.getenv("EXTRACTION_WORKERS", "2")))
+# Maximum number of tasks submitted to the pool at once (running + queued).
+EXTRACTION_QUEUE_SIZE = max(1, int(os.getenv("EXTRACTION_QUEUE_SIZE", "16")))
+# Seconds a request waits for its task before giving up with a 504.
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "60"))
+# "spawn" keeps torch/tokenizer threads out of forked children.
+EXTRACTION_START_METHOD = os.getenv("EXTRACTION_START_METHOD", "spawn")
+
+_executor: Optional[ProcessPoolExecutor] = None
+_in_flight = 0
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Return the process pool, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=EXTRACTION_WORKERS,
+            mp_context=multiprocessing.get_context(EXTRACTION_START_METHOD)
+        )
+    return _executor
+
+
+def shutdown_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _release_slot(_future) -> None:
+    global _in_flight
+    _in_flight -= 1
+
+
+def _collect_cache_stats(future) -> None:
+    # Runs even when the waiting request timed out, so no worker's counters are lost.
+    if not future.cancelled() and future.exception() is None:
+        record_worker_cache_stats(future.result()[1])
+
+
+def pool_stats() -> dict:
+    return {
+        "workers": EXTRACTION_WORKERS,
+        "in_flight": _in_flight,
+        "queue_size": EXTRACTION_QUEUE_SIZE,
+        "timeout": EXTRACTION_TIMEOUT,
+    }
+
+
+async def run_in_pool(fn: Callable[..., Any], *args, timeout: Optional[float] = None, **kwargs) -> Any:
+    """
+    Run a CPU-bound function in the extraction process pool without blocking the event loop.
+
+    Raises HTTP 503 when EXTRACTION_QUEUE_SIZE tasks are already submitted or the NLTK data
+    RAKE needs is missing, and HTTP 504 when the task does not finish within `timeout`
+    (default EXTRACTION_TIMEOUT). A timed-out task keeps its slot until the worker actually
+    finishes it, so the bound stays honest.
+    """
+    global _executor, _in_flight
+    if _in_flight >= EXTRACTION_QUEUE_SIZE:
+        raise HTTPException(
+            status_code=503,
+            detail="Concept extraction is at capacity, please retry shortly.",
+            headers={"Retry-After": "5"}
+        )
+
+    loop = asyncio.get_running_loop()
+    try:
+        future = loop.run_in_executor(
+            get_executor(), functools.partial(run_counting_cache_stats, fn, *args, **kwargs)
+        )
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); start a fresh pool for later requests.
+        _executor = None
+        raise HTTPException(status_code=503, detail="Concept extraction workers restarting, please retry.")
+    _in_flight += 1
+    future.add_done_callback(_release_slot)
+    future.add_done_callback(_collect_cache_stats)
+
+    try:
+        result, _ = await asyncio.wait_for(asyncio.shield(future), timeout or EXTRACTION_TIMEOUT)
+        return result
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Concept extraction timed out.")
+    except NLTKResourceMissing as e:
+        raise HTTPException(status_code=503, detail=f"Concept extraction unavailable: {e}")
+    except BrokenProcessPool:
+        _executor = None
+        raise HTTPException(status_code=503, detail="Concept extraction workers restarting, please retry.")
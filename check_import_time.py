@@ -0,0 +1,44 @@
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Maximum seconds `import main` may take before this check fails.
+budget = float(os.environ.get('IMPORT_TIME_BUDGET', '3.0'))
+
+# Import the app in a fresh interpreter so nothing is already cached in sys.modules.
+start = time.perf_counter()
+result = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', 'import main'],
+    capture_output=True,
+    text=True,
+    cwd=os.path.dirname(os.path.abspath(__file__)),
+)
+elapsed = time.perf_counter() - start
+
+if result.returncode != 0:
+    print(result.stderr)
+    print("Importing main failed!")
+    sys.exit(1)
+
+# Lines look like: "import time:       123 |      45678 | package.module"
+timings = []
+for line in result.stderr.splitlines():
+    match = re.match(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s+(.*)', line)
+    if match:
+        timings.append((int(match.group(2)), match.group(3).strip()))
+
+print("Slowest imports (cumulative):")
+for cumulative_us, module in sorted(timings, reverse=True)[:15]:
+    print(f"  {cumulative_us / 1e6:7.3f}s  {module}")
+
+heavy = [module for _, module in timings if module.strip() in ('torch', 'sentence_transformers')]
+if heavy:
+    print(f"Heavy modules imported at startup: {', '.join(sorted(set(heavy)))}")
+
+print(f"Startup import took {elapsed:.2f}s (budget {budget:.2f}s)")
+if elapsed > budget or heavy:
+    print("Import-time budget check failed!")
+    sys.exit(1)
+print("Import-time budget check passed!")
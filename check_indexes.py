@@ -0,0 +1,61 @@
+import asyncio
+import sys
+from datetime import datetime
+
+from app.db import client, ensure_indexes
+
+# Query shapes the application runs on hot paths, with placeholder values. Each must be
+# answered from an index rather than a collection scan.
+CLASS_ID = "check-class"
+USER_ID = "check-user"
+QUERIES = [
+    ("auth_db", "users", {"username": USER_ID}),
+    ("notes_db", "notes", {"class_id": CLASS_ID}),
+    ("notes_db", "notes", {"user_id": USER_ID, "class_id": CLASS_ID}),
+    ("notes_db", "notes", {"class_id": CLASS_ID, "user_id": {"$ne": USER_ID}}),
+    ("notes_db", "student_concepts", {"user_id": USER_ID, "class_id": CLASS_ID}),
+    ("notes_db", "student_concepts", {"class_id": CLASS_ID, "user_id": {"$in": [USER_ID]}}),
+    ("notes_db", "student_concepts", {"class_id": CLASS_ID, "concept_embeddings": {"$exists": True}, "updated_at": {"$gte": 0}}),
+    ("notes_db", "note_concept_stats", {"class_id": CLASS_ID, "user_id": USER_ID}),
+    ("notes_db", "class_concept_buckets", {"class_id": CLASS_ID}),
+    ("notes_db", "class_versions", {"class_id": CLASS_ID}),
+    ("notes_db", "analysis_jobs", {"user_id": USER_ID, "class_id": CLASS_ID, "class_version": 0}),
+    ("notes_db", "analysis_jobs", {"status": "queued"}),
+    ("notes_db", "lobbies", {"created_at": {"$gt": datetime(1970, 1, 1)}}),
+]
+
+
+def plan_stages(plan):
+    """
+    (stage, index name) pairs of a winning plan, outermost first.
+    """
+    plan = plan.get("queryPlan", plan)
+    stages = [(plan.get("stage"), plan.get("indexName"))]
+    children = plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else [])
+    for child in children:
+        stages.extend(plan_stages(child))
+    return stages
+
+
+async def main() -> int:
+    # Creating indexes first makes this the migration step as well as the check.
+    report = await ensure_indexes()
+    failed = bool(report["errors"])
+
+    for database, collection, query in QUERIES:
+        explain = await client[database][collection].find(query).limit(1).explain()
+        stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+        indexes = [name for stage, name in stages if name]
+        uses_index = bool(indexes) and all(stage != "COLLSCAN" for stage, _ in stages)
+        failed = failed or not uses_index
+        print(f"  {'ok  ' if uses_index else 'SCAN'}  {database}.{collection} {query} -> {', '.join(indexes) or 'COLLSCAN'}")
+
+    if failed:
+        print("Index check failed!")
+        return 1
+    print("Index check passed!")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -6,6 +6,21 @@ import Lobby from '../System/Lobby';
 import AnalysisPage from './AnalysisPage';
 import { useAuth } from '../../context/AuthContext';
 
+// Fetch every page of the lobby list, following the X-Next-Cursor header.
+const fetchAllLobbies = async (token) => {
+  const lobbies = [];
+  let cursor = null;
+  do {
+    const response = await axios.get('http://localhost:8000/lobby/lobbies', {
+      headers: { Authorization: `Bearer ${token}` },
+      params: cursor ? { cursor } : {}
+    });
+    lobbies.push(...response.data);
+    cursor = response.headers['x-next-cursor'] || null;
+  } while (cursor);
+  return lobbies;
+};
+
 const Hub = () => {
   const location = useLocation();
   const navigate = useNavigate();
@@ -23,12 +38,9 @@ const Hub = () => {
   useEffect(() => {
     if (token) {
       setIsLoading(true);
-      axios
-        .get('http://localhost:8000/lobby/lobbies', {
-          headers: { Authorization: `Bearer ${token}` }
-        })
-        .then((response) => {
-          setLobbies(response.data);
+      fetchAllLobbies(token)
+        .then((allLobbies) => {
+          setLobbies(allLobbies);
           setIsLoading(false);
         })
         .catch((error) => {
@@ -54,13 +66,9 @@ const Hub = () => {
           headers: { Authorization: `Bearer ${token}` }
         }
       )
-      .then(() => {
-        return axios.get('http://localhost:8000/lobby/lobbies', {
-          headers: { Authorization: `Bearer ${token}` }
-        });
-      })
-      .then((response) => {
-        setLobbies(response.data);
+      .then(() => fetchAllLobbies(token))
+      .then((allLobbies) => {
+        setLobbies(allLobbies);
         setIsLoading(false);
       })
       .catch((error) => {
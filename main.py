@@ -1,15 +1,64 @@
-from fastapi import FastAPI, Depends
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes.routes import router as note_router
 from app.routes.lobby import router as lobby_router
 from app.routes.auth import router as auth_router, get_current_user
+from app.db import ensure_indexes
+from app.extract import warm_up
+from app.hashing import shutdown_hash_pool
+from app.jobs import resume_analysis_jobs, shutdown_analysis_workers
+from app.workers import EXTRACTION_WORKERS, run_in_pool, shutdown_pool
 from dotenv import load_dotenv
 import os
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+# Load NLTK resources and the embedding model into every extraction worker at startup.
+# With WARMUP_ON_STARTUP=0 they are loaded lazily on first use instead.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "300"))
+# Create missing MongoDB indexes at startup. Set to 0 where check_indexes.py runs as a
+# separate migration step instead.
+ENSURE_INDEXES_ON_STARTUP = os.getenv("ENSURE_INDEXES_ON_STARTUP", "1") == "1"
+
+
+async def warm_up_workers(app: FastAPI):
+    try:
+        await asyncio.gather(*(run_in_pool(warm_up, timeout=WARMUP_TIMEOUT) for _ in range(EXTRACTION_WORKERS)))
+        app.state.ready = True
+        print("Warmup complete, ready to serve")
+    except Exception as e:
+        print(f"Warmup failed, /ready will keep reporting not ready: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve immediately; the readiness flag flips once the workers are warm.
+    app.state.ready = not WARMUP_ON_STARTUP
+    warmup_task = asyncio.create_task(warm_up_workers(app)) if WARMUP_ON_STARTUP else None
+    if ENSURE_INDEXES_ON_STARTUP:
+        try:
+            await ensure_indexes()
+        except Exception as e:
+            print(f"Could not ensure database indexes: {e}")
+    # Pick up analysis jobs queued before the last shutdown.
+    try:
+        await resume_analysis_jobs()
+    except Exception as e:
+        print(f"Could not resume analysis jobs: {e}")
+    yield
+    if warmup_task:
+        warmup_task.cancel()
+    await shutdown_analysis_workers()
+    # Stop the concept extraction worker processes.
+    shutdown_pool()
+    shutdown_hash_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS to allow requests from both frontend development origins
 app.add_middleware(
@@ -18,6 +67,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let the browser read the lobby list's pagination cursor and ETag.
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 # Include routers
@@ -25,6 +76,14 @@ app.include_router(auth_router, prefix="/auth", tags=["auth"])
 app.include_router(note_router, prefix="/notes", tags=["notes"], dependencies=[Depends(get_current_user)])
 app.include_router(lobby_router, prefix="/lobby", tags=["lobby"], dependencies=[Depends(get_current_user)])
 
+
+# Readiness probe: 503 until NLTK resources and the embedding model are loaded.
+@app.get("/ready")
+async def ready():
+    if not app.state.ready:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return {"ready": True}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from app.concept_index import STATISTIC_FIELDS, _decode_statistics, _encode_statistics
+from app.extract import NLTKResourceMissing, combine_phrase_statistics, ensure_nltk_resources, phrase_statistics
+
+KEYS = ["cell", "cell membrane", "e.g. lipid", "$price", "100%", "a\x00b", "u.s. market", "atp"]
+
+
+def random_statistics(rng):
+    return {
+        field: {key: rng.randint(1, 5) for key in rng.sample(KEYS, rng.randint(0, len(KEYS)))}
+        for field in STATISTIC_FIELDS
+    }
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_add_then_subtract_round_trips(seed):
+    rng = random.Random(seed)
+    notes = [random_statistics(rng) for _ in range(rng.randint(1, 6))]
+    total = {field: {} for field in STATISTIC_FIELDS}
+    for note in notes:
+        total = combine_phrase_statistics(total, note)
+
+    for index, note in enumerate(notes):
+        others = {field: {} for field in STATISTIC_FIELDS}
+        for other in notes[:index] + notes[index + 1:]:
+            others = combine_phrase_statistics(others, other)
+        assert combine_phrase_statistics(total, note, sign=-1) == others
+
+    remaining = total
+    for note in notes:
+        remaining = combine_phrase_statistics(remaining, note, sign=-1)
+    assert remaining == {field: {} for field in STATISTIC_FIELDS}
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_encoded_statistics_round_trip(seed):
+    statistics = random_statistics(random.Random(seed))
+    assert _decode_statistics(_encode_statistics(statistics)) == statistics
+    for field in STATISTIC_FIELDS:
+        assert not any(c in key for key in _encode_statistics(statistics)[field] for c in ".$\x00")
+
+
+def test_class_minus_note_matches_other_notes():
+    try:
+        ensure_nltk_resources()
+    except NLTKResourceMissing as exc:
+        pytest.skip(str(exc))
+    notes = [
+        "The cell membrane is a lipid bilayer. Proteins float in the membrane!",
+        "Supply and demand set the market price. The price of ATP is energy.",
+        "Mitochondria make ATP for the cell. The cell membrane controls transport.",
+    ]
+    total = {field: {} for field in STATISTIC_FIELDS}
+    for note in notes:
+        total = combine_phrase_statistics(total, _decode_statistics(_encode_statistics(phrase_statistics(note))))
+    for index, note in enumerate(notes):
+        others = " ".join(notes[:index] + notes[index + 1:])
+        assert combine_phrase_statistics(total, phrase_statistics(note), sign=-1) == phrase_statistics(others)
@@ -0,0 +1,29 @@
+from app.condense import condense_text, estimate_tokens
+
+
+def test_text_without_sentence_punctuation_is_condensed_not_emptied():
+    # Bulleted notes typed into the textarea: no ".", "!" or "?" anywhere.
+    text = "\n".join(f"- mitochondria produce energy for cell number {i}" for i in range(100))
+    condensed, stats = condense_text(text, ["mitochondria", "energy"], token_budget=100)
+
+    assert condensed
+    assert estimate_tokens(condensed) <= 100
+    assert "mitochondria" in condensed
+    assert stats["tokens_saved"] == stats["original_tokens"] - stats["condensed_tokens"]
+    assert stats["tokens_saved"] < stats["original_tokens"]
+
+
+def test_first_sentence_larger_than_budget_is_condensed_not_emptied():
+    long_sentence = " ".join(["supply and demand determine the market price"] * 60) + "."
+    text = long_sentence + " Enzymes catalyse reactions. Ribosomes make protein."
+    condensed, stats = condense_text(text, ["unrelated concept"], token_budget=50)
+
+    assert condensed
+    assert estimate_tokens(condensed) <= 50
+    assert stats["sentences_kept"] >= 1
+
+
+def test_single_word_larger_than_budget_is_truncated():
+    condensed, _ = condense_text("x" * 1000, [], token_budget=10)
+
+    assert condensed == "x" * 40
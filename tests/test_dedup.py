@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+from app.extract import filter_similar_phrases, is_similar
+
+WORDS = ["cell", "membrane", "supply", "demand", "price", "lipid", "bilayer", "protein",
+         "energy", "market", "curve", "atp", "mitochondria", "the", "of"]
+THRESHOLDS = [0.0, 0.3, 0.5, 0.65, 0.75, 0.85, 1.0, 1.1]
+
+
+def pairwise_dedup(phrases, threshold):
+    kept = []
+    for phrase in phrases:
+        if not any(is_similar(phrase, existing, threshold, "string") for existing in kept):
+            kept.append(phrase)
+    return kept
+
+
+def random_phrases(rng, count):
+    phrases = []
+    for _ in range(count):
+        phrase = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        if rng.random() < 0.2:
+            phrase = phrase.upper() + "!"
+        if rng.random() < 0.1:
+            # Past difflib's 200-character autojunk cutoff.
+            phrase = phrase * rng.randint(5, 20)
+        if rng.random() < 0.05:
+            # Normalizes to the empty string.
+            phrase = "!!"
+        phrases.append(phrase)
+    return phrases
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_string_dedup_matches_pairwise_is_similar(seed):
+    rng = random.Random(seed)
+    phrases = random_phrases(rng, rng.randint(0, 60))
+    for threshold in THRESHOLDS:
+        assert filter_similar_phrases(phrases, threshold, "string") == pairwise_dedup(phrases, threshold)
+
+
+def test_string_dedup_limit_returns_the_unlimited_prefix():
+    phrases = random_phrases(random.Random(99), 200)
+    full = filter_similar_phrases(phrases, 0.75, "string")
+    for limit in (0, 1, 5, len(full), len(full) + 10):
+        assert filter_similar_phrases(phrases, 0.75, "string", limit=limit) == full[:limit]
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+from app.extract import (
+    NLTKResourceMissing,
+    add_phrase_statistics,
+    ensure_nltk_resources,
+    phrase_statistics,
+    rank_phrases,
+    split_text_chunks,
+)
+
+try:
+    ensure_nltk_resources()
+except NLTKResourceMissing as exc:
+    pytest.skip(str(exc), allow_module_level=True)
+
+WORDS = ["cell", "membrane", "supply", "demand", "price", "lipid", "bilayer", "protein",
+         "energy", "market", "curve", "atp", "the", "of", "and", "is", "in", "e.g.", "3.5",
+         "U.S.", "what's", "(see", "fig)", "--", "a,", "b;"]
+ENDINGS = [".", "!", "?", " .", "...", ". .", ""]
+
+
+def random_text(rng, sentences):
+    parts = []
+    for _ in range(sentences):
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        parts.append(sentence + rng.choice(ENDINGS))
+    separators = [" ", "\n", "\n\n", "  "]
+    return "".join(part + rng.choice(separators) for part in parts)
+
+
+def chunked_statistics(text, chunk_size):
+    total = {}
+    for chunk in split_text_chunks(text, chunk_size):
+        add_phrase_statistics(total, phrase_statistics(chunk))
+    return total
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("chunk_size", [1, 40, 200, 100000])
+def test_chunked_ranking_matches_single_pass(seed, chunk_size):
+    text = random_text(random.Random(seed), 60)
+    assert "".join(split_text_chunks(text, chunk_size)) == text
+    whole = phrase_statistics(text)
+    assert chunked_statistics(text, chunk_size) == whole
+    assert rank_phrases(chunked_statistics(text, chunk_size)) == rank_phrases(whole)
+
+
+def test_rank_phrases_matches_rake():
+    from app.extract import _get_rake
+
+    text = random_text(random.Random(7), 80)
+    rake = _get_rake()
+    rake.extract_keywords_from_text(text)
+    assert rank_phrases(phrase_statistics(text)) == rake.get_ranked_phrases()
@@ -0,0 +1,75 @@
+import random
+import zlib
+
+import numpy as np
+import pytest
+
+import app.embeddings
+from app.cache import TTLCache
+from app.embeddings import embedding_cache_stats
+from app.extract import filter_similar_phrases, filter_similar_phrases_semantic, is_similar
+
+WORDS = ["cell", "membrane", "supply", "demand", "price", "lipid", "bilayer", "protein",
+         "energy", "market", "curve", "atp", "mitochondria"]
+# Away from the exact ties (orthogonal or identical vectors) the integer fake produces,
+# where the last-ulp rounding of a batched and a 1x1 matrix product can differ.
+THRESHOLDS = [-0.5, 0.05, 0.5, 0.75, 0.9, 1.1]
+
+
+class FakeModel:
+    """
+    Deterministic stand-in for the sentence-transformer: a phrase is the sum of
+    per-word vectors, so phrases sharing words come out similar.
+    """
+
+    def encode(self, texts, convert_to_numpy=True):
+        vectors = np.zeros((len(texts), 16), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.split():
+                vectors[row] += np.random.default_rng(zlib.crc32(word.encode())).integers(-3, 4, 16)
+        return vectors
+
+    def get_sentence_embedding_dimension(self):
+        return 16
+
+
+@pytest.fixture(autouse=True)
+def fake_model(monkeypatch):
+    model_key = (app.embeddings.EMBEDDING_MODEL_NAME, app.embeddings.EMBEDDING_BACKEND)
+    monkeypatch.setitem(app.embeddings._models, model_key, FakeModel())
+    monkeypatch.setattr(app.embeddings, "_memory_cache", TTLCache(maxsize=10000))
+    monkeypatch.setattr(app.embeddings, "EMBEDDING_CACHE_PATH", None)
+
+
+def pairwise_dedup(phrases, threshold):
+    kept = []
+    for phrase in phrases:
+        if not any(is_similar(phrase, existing, threshold, "semantic") for existing in kept):
+            kept.append(phrase)
+    return kept
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_batched_semantic_dedup_matches_pairwise_is_similar(seed):
+    rng = random.Random(seed)
+    phrases = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+               for _ in range(rng.randint(0, 40))]
+    for threshold in THRESHOLDS:
+        expected = pairwise_dedup(phrases, threshold)
+        assert filter_similar_phrases_semantic(phrases, threshold)["phrases"] == expected
+        assert filter_similar_phrases(phrases, threshold, "semantic") == expected
+
+
+def test_forward_passes_saved_only_counts_passes_that_ran():
+    phrases = ["cell membrane", "supply demand", "lipid bilayer"]
+    first = filter_similar_phrases_semantic(phrases, 0.99)
+    assert first["forward_passes"] == 6
+    assert first["forward_passes_saved"] == 5
+    # Every phrase is cached now, so the batch runs no forward pass and saves none.
+    assert filter_similar_phrases_semantic(phrases, 0.99)["forward_passes_saved"] == 0
+
+
+def test_forward_passes_saved_reach_the_embedding_stats():
+    before = embedding_cache_stats()["dedup_forward_passes_saved"]
+    filter_similar_phrases(["price curve", "market energy", "atp"], 0.99, "semantic")
+    assert embedding_cache_stats()["dedup_forward_passes_saved"] == before + 5